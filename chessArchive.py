@@ -0,0 +1,319 @@
+"""
+Append-only binary game archive: every game is a small header followed by its packed 16-bit moves, so a game
+takes a few bytes per move. A separate index file holds the offset of every game, so game k is found with one
+lookup and any position of it is replayed from the moves, without parsing PGN. Both files are memory-mapped.
+
+    games.cga      "CGA1", then per game: plies, result, flags (GAME_HEADER), the start position if it is not
+                   the standard one (START_HEADER), plies little-endian 16-bit moves
+    games.cga.idx  "CGI1", then the little-endian 64-bit offset of every game in games.cga
+
+    python chessArchive.py build games.pgn -o games.cga
+    python chessArchive.py show games.cga --game 12 --ply 30
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+import chessBook
+import chessEngine
+
+ARCHIVE_MAGIC = b"CGA1"
+INDEX_MAGIC = b"CGI1"
+GAME_HEADER = struct.Struct("<IBB") # plies, result, flags
+START_HEADER = struct.Struct("<34sHH") # GameState.encodePosition, halfmove clock, fullmove number
+OFFSET = struct.Struct("<Q")
+FLAG_START_POSITION = 1 # the game does not start from the standard position, a START_HEADER follows
+RESULTS = ("*", "1-0", "0-1", "1/2-1/2")
+START_FEN = chessEngine.GameState().getFen()
+WRITE_BUFFER = 1 << 20
+
+
+def indexPath(path):
+    return path + ".idx"
+
+
+def gameEnd(data, offset):
+    '''Offset just past the game stored at offset of the archive data, None if the game does not fit in data'''
+    if offset < len(ARCHIVE_MAGIC) or offset + GAME_HEADER.size > len(data):
+        return None
+    plies, result, flags = GAME_HEADER.unpack_from(data, offset)
+    end = offset + GAME_HEADER.size + (START_HEADER.size if flags & FLAG_START_POSITION else 0) + 2 * plies
+    return end if end <= len(data) and result < len(RESULTS) else None
+
+
+def openData(path):
+    '''(file, read-only mmap) of the data file of an archive, checking its magic'''
+    f = open(path, "rb")
+    if os.path.getsize(path) < len(ARCHIVE_MAGIC) or f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+        f.close()
+        raise ValueError("not a game archive: " + repr(path))
+    return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def rebuildIndex(path):
+    '''Write the index of an archive again by walking its game headers. Returns the number of games'''
+    f, data = openData(path)
+    offsets = []
+    offset = len(ARCHIVE_MAGIC)
+    while True:
+        end = gameEnd(data, offset)
+        if end is None:
+            break
+        offsets.append(offset)
+        offset = end
+    data.close()
+    f.close()
+    with open(indexPath(path), "wb") as index:
+        index.write(INDEX_MAGIC)
+        index.write(b"".join(OFFSET.pack(offset) for offset in offsets))
+    return len(offsets)
+
+
+def gameResult(gs):
+    '''Result of the game of gs as far as the rules decide it, "*" while it is still open'''
+    moves, inCheck = gs.getCachedMoves()
+    if not moves:
+        if inCheck:
+            return "0-1" if gs.whiteToMove else "1-0"
+        return "1/2-1/2"
+    if gs.repetitionCount() >= 3 or gs.isFiftyMoveDraw():
+        return "1/2-1/2"
+    return "*"
+
+
+def gameRecord(gs):
+    '''(FEN of the position the game of gs started from, packed moves played since)'''
+    codes = list(gs.codeLog)
+    for code in codes:
+        gs.undoPackedMove()
+    fen = gs.getFen()
+    for code in codes:
+        gs.makePackedMove(code)
+    return fen, codes
+
+
+class ArchiveWriter():
+    '''Appends games to an archive, creating it if needed, and never rewrites the games already stored.
+    A missing index is rebuilt from the game headers. Writes are buffered, flush() makes them visible
+    to readers opened afterwards. After an interrupted write, index entries of games that did not make it
+    to the data file are dropped, complete games that never got an index entry are indexed again, and only
+    a torn last game is cut off'''
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            if os.path.exists(indexPath(path)):
+                raise ValueError("index without its archive: " + repr(indexPath(path)))
+            with open(path, "wb") as f:
+                f.write(ARCHIVE_MAGIC)
+        if not os.path.exists(indexPath(path)):
+            rebuildIndex(path)
+        with open(indexPath(path), "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("not a game archive index: " + repr(indexPath(path)))
+        self.games = (os.path.getsize(indexPath(path)) - len(INDEX_MAGIC)) // OFFSET.size
+        self.end = len(ARCHIVE_MAGIC)
+        dataFile, data = openData(path)
+        with open(indexPath(path), "rb") as index:
+            while self.games: # the end of the last game that is complete in the data file
+                index.seek(len(INDEX_MAGIC) + (self.games - 1) * OFFSET.size)
+                end = gameEnd(data, OFFSET.unpack(index.read(OFFSET.size))[0])
+                if end is not None:
+                    self.end = end
+                    break
+                self.games -= 1
+        recovered = [] # complete games written to the data file whose index entries were lost
+        while True:
+            end = gameEnd(data, self.end)
+            if end is None:
+                break
+            recovered.append(self.end)
+            self.end = end
+        data.close()
+        dataFile.close()
+        with open(path, "r+b") as f:
+            f.truncate(self.end)
+        with open(indexPath(path), "r+b") as f:
+            f.truncate(len(INDEX_MAGIC) + self.games * OFFSET.size)
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(OFFSET.pack(offset) for offset in recovered))
+        self.games += len(recovered)
+        self.data = open(path, "ab", buffering=WRITE_BUFFER)
+        self.index = open(indexPath(path), "ab", buffering=WRITE_BUFFER)
+
+    def writeGame(self, codes, result="*", fen=None):
+        '''Append a game given as packed moves, played from fen (default the standard start). Returns its number'''
+        fen = fen or START_FEN
+        flags = 0 if fen == START_FEN else FLAG_START_POSITION
+        record = bytearray(GAME_HEADER.pack(len(codes), RESULTS.index(result), flags))
+        if flags & FLAG_START_POSITION:
+            gs = chessEngine.GameState(fen)
+            record += START_HEADER.pack(gs.encodePosition(), gs.halfmoveClock, gs.fullmoveNumber)
+        moves = array("H", codes)
+        if sys.byteorder == "big":
+            moves.byteswap()
+        record += moves.tobytes()
+        self.data.write(record)
+        self.index.write(OFFSET.pack(self.end))
+        self.end += len(record)
+        self.games += 1
+        return self.games - 1
+
+    def writeGameState(self, gs, result=None):
+        '''Append the game played in gs, with the result the rules give unless one is passed'''
+        fen, codes = gameRecord(gs)
+        return self.writeGame(codes, result or gameResult(gs), fen)
+
+    def writeGames(self, games):
+        '''Bulk append (codes, result, fen) tuples from any iterable, e.g. a generator. Returns how many'''
+        count = 0
+        for codes, result, fen in games:
+            self.writeGame(codes, result, fen)
+            count += 1
+        return count
+
+    def flush(self):
+        # the data first, so an index entry never points past the end of the data
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GameArchive():
+    '''Read-only view of an archive. It sees the games that were flushed when it was opened'''
+    def __init__(self, path):
+        self.dataFile, self.data = openData(path)
+        self.indexFile = open(indexPath(path), "rb")
+        if os.path.getsize(indexPath(path)) < len(INDEX_MAGIC) or self.indexFile.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            self.data.close()
+            self.dataFile.close()
+            self.indexFile.close()
+            raise ValueError("not a game archive index: " + repr(indexPath(path)))
+        self.index = mmap.mmap(self.indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = (len(self.index) - len(INDEX_MAGIC)) // OFFSET.size
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        self.dataFile.close()
+        self.indexFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def header(self, game):
+        '''(offset, plies, result, flags) of a game. Raises ValueError if the data file does not hold all of it'''
+        if not 0 <= game < self.size:
+            raise IndexError("no game %d in an archive of %d" % (game, self.size))
+        offset = OFFSET.unpack_from(self.index, len(INDEX_MAGIC) + game * OFFSET.size)[0]
+        if gameEnd(self.data, offset) is None:
+            raise ValueError("game %d is cut off, the archive was not written completely" % game)
+        plies, result, flags = GAME_HEADER.unpack_from(self.data, offset)
+        return offset, plies, RESULTS[result], flags
+
+    def movesOffset(self, game):
+        offset, plies, result, flags = self.header(game)
+        return offset + GAME_HEADER.size + (START_HEADER.size if flags & FLAG_START_POSITION else 0)
+
+    def result(self, game):
+        return self.header(game)[2]
+
+    def codes(self, game, plies=None):
+        '''array('H') of the first plies packed moves of a game, all of them by default'''
+        offset, total, result, flags = self.header(game)
+        plies = total if plies is None else min(plies, total)
+        start = self.movesOffset(game)
+        moves = array("H")
+        moves.frombytes(self.data[start:start + 2 * plies])
+        if sys.byteorder == "big":
+            moves.byteswap()
+        return moves
+
+    def startState(self, game):
+        '''New GameState at the position the game started from'''
+        offset, plies, result, flags = self.header(game)
+        if not flags & FLAG_START_POSITION:
+            return chessEngine.GameState()
+        position, halfmoveClock, fullmoveNumber = START_HEADER.unpack_from(self.data, offset + GAME_HEADER.size)
+        gs = chessEngine.GameState.decodePosition(position)
+        gs.halfmoveClock = halfmoveClock
+        gs.fullmoveNumber = fullmoveNumber
+        return gs
+
+    def gameState(self, game, ply=None, moveLog=False):
+        '''New GameState after the first ply moves of a game, all of them by default. With moveLog the moves
+        are played as Move objects, so the game can be shown and taken back move by move like one played on the board'''
+        gs = self.startState(game)
+        for code in self.codes(game, ply):
+            if moveLog:
+                gs.makeMove(chessEngine.Move.fromCode(code, gs.squares))
+            else:
+                gs.makePackedMove(code)
+        return gs
+
+
+def readPgnRecords(lines):
+    '''(codes, result, fen) of every readable game of a PGN text, stopping a game at its first unreadable move'''
+    for tags, moves, result in chessBook.readPgnGames(lines):
+        gs = chessEngine.GameState(tags.get("FEN"))
+        fen = gs.getFen()
+        codes = []
+        for san in moves:
+            try:
+                move = chessBook.parseSan(gs, san)
+            except ValueError:
+                break
+            gs.makeMove(move)
+            codes.append(move.code)
+        yield codes, result if result in RESULTS else "*", fen
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or read a binary game archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="append the games of PGN files to an archive")
+    build.add_argument("pgn", nargs="+")
+    build.add_argument("-o", "--output", required=True)
+    show = commands.add_parser("show", help="print a position of an archived game")
+    show.add_argument("archive")
+    show.add_argument("--game", type=int, default=0)
+    show.add_argument("--ply", type=int, help="default is the end of the game")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        games = 0
+        with ArchiveWriter(args.output) as writer:
+            for path in args.pgn:
+                with open(path, errors="replace") as f:
+                    games += writer.writeGames(readPgnRecords(f))
+            total = writer.games
+        size = os.path.getsize(args.output) + os.path.getsize(indexPath(args.output))
+        print("%d games appended, %d in %s (%d bytes)" % (games, total, args.output, size))
+    else:
+        with GameArchive(args.archive) as archive:
+            offset, plies, result, flags = archive.header(args.game)
+            gs = archive.gameState(args.game, args.ply)
+            print("game %d of %d, %d plies, %s" % (args.game, len(archive), plies, result))
+            print(gs.getFen())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Batch evaluation and attack maps for many positions at once with NumPy, for dataset work.
+A batch is an (N, 64) int8 array of piece codes (chessEngine.PIECE_CODES, 0 for an empty square) with the
+side to move, castling rights and en passant square alongside, unpacked from GameState.encodePosition.
+Piece-square evaluation and the attack counts of knights, kings and pawns are lookups and matrix products over
+the whole batch; sliders walk precomputed ray tables, where a square is reached while every square before it
+on the ray is empty. The results match the scalar chessEngine/chessEvaluation path, see crossCheck.
+
+    python chessBatch.py --positions 10000           random positions: cross-check and compare speed
+    python chessBatch.py --epd positions.epd         the same for the positions of an EPD or FEN file
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+import chessEngine
+from chessEngine import PIECES, PIECE_CODES
+from chessEvaluation import MATERIAL, MIDDLEGAME_SCORES, ENDGAME_SCORES, PHASE, MAX_PHASE, evaluate
+
+CHUNK_SIZE = 4096 # positions per step of the slider attacks, which need about 2 KB per position and direction
+SQUARES = np.arange(64)
+
+
+def pieceTable(values):
+    '''(13, 64) table of values[piece][sq], indexed by piece code, with a row of zeros for empty squares'''
+    return np.array([[0] * 64] + [values[piece] for piece in PIECES], dtype=np.int32)
+
+
+MATERIAL_TABLE = pieceTable({piece: [MATERIAL[piece]] * 64 for piece in PIECES})
+MIDDLEGAME_TABLE = pieceTable(MIDDLEGAME_SCORES)
+ENDGAME_TABLE = pieceTable(ENDGAME_SCORES)
+PHASE_TABLE = pieceTable({piece: [PHASE[piece]] * 64 for piece in PIECES})
+
+
+def bitboardMatrix(table):
+    '''(64, 64) matrix with [sq, target] set for every target in the bitboard table[sq].
+    Float32 so that products go through BLAS, the counts stay far below where floats lose exactness'''
+    return np.array([[table[sq] >> target & 1 for target in range(64)] for sq in range(64)], dtype=np.float32)
+
+
+KNIGHT_MATRIX = bitboardMatrix(chessEngine.KNIGHT_ATTACKS)
+KING_MATRIX = bitboardMatrix(chessEngine.KING_ATTACKS)
+PAWN_MATRICES = {color: bitboardMatrix(chessEngine.PAWN_ATTACKS[color]) for color in "wb"}
+
+
+def buildRaySquares(dr, dc):
+    '''(7, 64) table, [step, sq] is the square step + 1 steps from sq in the direction (dr, dc),
+    or 64 past the edge: a column that is always occupied and never counted'''
+    rays = np.full((7, 64), 64, dtype=np.intp)
+    for sq in range(64):
+        r, c = (sq >> 3) + dr, (sq & 7) + dc
+        step = 0
+        while 0 <= r <= 7 and 0 <= c <= 7:
+            rays[step, sq] = r*8 + c
+            r, c, step = r + dr, c + dc, step + 1
+    return rays
+
+
+def buildRayScatter(rays):
+    '''(7*64, 65) matrix that adds up, per target square, the (step, start square) entries of a ray table'''
+    scatter = np.zeros((7 * 64, 65), dtype=np.float32)
+    scatter[np.arange(7 * 64), rays.ravel()] = 1
+    return scatter
+
+
+RAY_SQUARES = {d: buildRaySquares(d[0], d[1]) for d in chessEngine.QUEEN_DIRECTIONS}
+RAY_SCATTER = {d: buildRayScatter(RAY_SQUARES[d]) for d in chessEngine.QUEEN_DIRECTIONS}
+
+
+def encodeBatch(states):
+    '''(boards, whiteToMove, castlingRights, enpassantSquare) of GameStates or their encodePosition bytes.
+    boards is (N, 64) int8, the rest are (N,) arrays'''
+    encoded = [state if isinstance(state, bytes) else state.encodePosition() for state in states]
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).reshape(len(encoded), 34)
+    boards = np.empty((len(encoded), 64), dtype=np.int8)
+    boards[:, 0::2] = data[:, :32] & 15
+    boards[:, 1::2] = data[:, :32] >> 4
+    whiteToMove = (data[:, 32] & 1) == 0
+    castlingRights = (data[:, 32] >> 1).astype(np.int8)
+    enpassantSquare = data[:, 33].astype(np.int8) - 1
+    return boards, whiteToMove, castlingRights, enpassantSquare
+
+
+def encodeFens(fens):
+    '''encodeBatch of positions given as FEN strings'''
+    return encodeBatch([chessEngine.GameState(fen) for fen in fens])
+
+
+def evaluateBatch(boards, whiteToMove):
+    '''(N,) static evaluations in centipawns for the side to move, equal to chessEvaluation.evaluate'''
+    codes = boards.astype(np.intp)
+    material = MATERIAL_TABLE[codes, SQUARES].sum(axis=1)
+    middlegame = MIDDLEGAME_TABLE[codes, SQUARES].sum(axis=1)
+    endgame = ENDGAME_TABLE[codes, SQUARES].sum(axis=1)
+    phase = np.minimum(PHASE_TABLE[codes, SQUARES].sum(axis=1), MAX_PHASE)
+    blend = middlegame * phase + endgame * (MAX_PHASE - phase)
+    score = material + np.sign(blend) * (np.abs(blend) // MAX_PHASE) # rounds towards zero like int()
+    return np.where(whiteToMove, score, -score)
+
+
+def attackCountsBatch(boards, chunkSize=CHUNK_SIZE):
+    '''(N, 2, 64) int8: [n, 0, sq] is how many white pieces attack sq, [n, 1, sq] how many black ones,
+    the same as GameState.computeAttackCounts. The attack masks are the counts > 0'''
+    counts = np.empty((len(boards), 2, 64), dtype=np.int8)
+    for first in range(0, len(boards), chunkSize):
+        counts[first:first + chunkSize] = attackCountsChunk(boards[first:first + chunkSize])
+    return counts
+
+
+def attackCountsChunk(boards):
+    counts = np.zeros((len(boards), 2, 64), dtype=np.float32)
+    for side, color in enumerate("wb"):
+        counts[:, side] = (boards == PIECE_CODES[color + "p"]).astype(np.float32) @ PAWN_MATRICES[color]
+        counts[:, side] += (boards == PIECE_CODES[color + "N"]).astype(np.float32) @ KNIGHT_MATRIX
+        counts[:, side] += (boards == PIECE_CODES[color + "K"]).astype(np.float32) @ KING_MATRIX
+
+    # the sentinel column 64 is occupied, so every ray stops there at the latest
+    occupied = np.concatenate([boards != 0, np.ones((len(boards), 1), dtype=bool)], axis=1)
+    for d in chessEngine.QUEEN_DIRECTIONS:
+        blocked = occupied[:, RAY_SQUARES[d]] # (N, 7, 64)
+        reached = np.empty(blocked.shape, dtype=bool) # a step is reached when no step before it is blocked
+        reached[:, 0] = True
+        for step in range(1, 7):
+            np.logical_and(reached[:, step - 1], ~blocked[:, step - 1], out=reached[:, step])
+        kind = "R" if d[0] == 0 or d[1] == 0 else "B"
+        for side, color in enumerate("wb"):
+            sliders = (boards == PIECE_CODES[color + kind]) | (boards == PIECE_CODES[color + "Q"])
+            attacked = (reached & sliders[:, None, :]).reshape(len(boards), 7 * 64).astype(np.float32)
+            counts[:, side] += (attacked @ RAY_SCATTER[d])[:, :64]
+    return counts.astype(np.int8)
+
+
+def inCheckBatch(boards, whiteToMove, counts=None):
+    '''(N,) bool, whether the side to move is in check. counts can be passed if attackCountsBatch already ran'''
+    if counts is None:
+        counts = attackCountsBatch(boards)
+    kings = np.where(whiteToMove, PIECE_CODES["wK"], PIECE_CODES["bK"])
+    kingSquares = (boards == kings[:, None]).argmax(axis=1)
+    return counts[np.arange(len(boards)), np.where(whiteToMove, 1, 0), kingSquares] > 0
+
+
+def legalMoveCounts(states):
+    '''(N,) legal move counts of GameStates. Pins, en passant and castling make legality branchy,
+    so this stays on the scalar generator, with one shared move buffer'''
+    buffer = chessEngine.newMoveBuffer()
+    return np.array([gs.getLegalMoveCodes(buffer) for gs in states], dtype=np.int16)
+
+
+def crossCheck(states):
+    '''[(index, term)] of every position where the batch results differ from the scalar path'''
+    boards, whiteToMove, castlingRights, enpassantSquare = encodeBatch(states)
+    scores = evaluateBatch(boards, whiteToMove)
+    counts = attackCountsBatch(boards)
+    checks = inCheckBatch(boards, whiteToMove, counts)
+    mismatches = []
+    for index, gs in enumerate(states):
+        if scores[index] != evaluate(gs):
+            mismatches.append((index, "evaluation"))
+        expected = gs.computeAttackCounts()
+        if counts[index, 0].tolist() != expected["w"] or counts[index, 1].tolist() != expected["b"]:
+            mismatches.append((index, "attacks"))
+        if checks[index] != gs.inCheck():
+            mismatches.append((index, "check"))
+    return mismatches
+
+
+def randomPositions(count, seed=0, maxPlies=200):
+    '''count GameStates met in random games'''
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        gs = chessEngine.GameState()
+        for ply in range(maxPlies):
+            moves = gs.getValidMoves()
+            if not moves or len(positions) == count:
+                break
+            gs.makeMove(rng.choice(moves))
+            positions.append(chessEngine.GameState.decodePosition(gs.encodePosition()))
+    return positions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cross-check the batch evaluation and attack maps against the "
+                                                 "scalar engine and compare their speed")
+    parser.add_argument("--positions", type=int, default=2000, help="number of random positions")
+    parser.add_argument("--epd", help="use the positions of this EPD or FEN file instead")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.epd:
+        import chessEpd
+        with open(args.epd) as f:
+            states = [chessEngine.GameState(chessEpd.parseEpd(line)[0]) for number, line in chessEpd.readPositions(f)]
+    else:
+        states = randomPositions(args.positions, args.seed)
+
+    start = time.perf_counter()
+    for gs in states:
+        evaluate(gs)
+        gs.computeAttackCounts()
+    scalarTime = time.perf_counter() - start
+    start = time.perf_counter()
+    boards, whiteToMove, castlingRights, enpassantSquare = encodeBatch(states)
+    evaluateBatch(boards, whiteToMove)
+    inCheckBatch(boards, whiteToMove, attackCountsBatch(boards))
+    batchTime = time.perf_counter() - start
+
+    mismatches = crossCheck(states)
+    for index, term in mismatches[:20]:
+        print("mismatch in %s: %s" % (term, states[index].getFen()))
+    print(json.dumps({"positions": len(states), "mismatches": len(mismatches), "scalarTime": round(scalarTime, 4),
+                      "batchTime": round(batchTime, 4),
+                      "speedup": round(scalarTime / batchTime, 1) if batchTime > 0 else None}))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Opening book on disk: a header followed by fixed-width records (zobrist key, packed move, weight) sorted by key.
+A lookup memory-maps the file and binary-searches it, so opening a book is instant and takes no memory
+however large the book is. The keys are GameState.zobristKey, so a book only works with this engine's hashing.
+
+    python chessBook.py build games.pgn more.pgn -o book.bin --plies 20 --min-games 2
+    python chessBook.py probe book.bin --fen "<FEN>"
+
+    with OpeningBook("book.bin") as book:
+        for move, weight in book.candidates(gs): ...
+"""
+import argparse
+import mmap
+import random
+import re
+import struct
+import sys
+import chessEngine
+
+BOOK_MAGIC = b"CBK1"
+HEADER = struct.Struct(">4sI") # magic, number of records
+RECORD = struct.Struct(">QHH") # zobrist key, packed move, weight
+MAX_WEIGHT = 0xFFFF
+
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+PGN_TOKEN = re.compile(r"\{[^}]*\}|;[^\n]*|\([^()]*\)|\$\d+|\d+\.+|\S+")
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+
+def parseSan(gs, san):
+    '''The valid Move of gs written as san in standard algebraic notation, e.g. Nbd7, exd8=Q+, O-O.
+    Raises ValueError if it matches no legal move or more than one'''
+    text = san.rstrip("+#!?")
+    moves = gs.getValidMoves()
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        kingSide = len(text) == 3
+        matches = [move for move in moves if move.isCastleMove and (move.endCol > move.startCol) == kingSide]
+    else:
+        match = SAN_PATTERN.match(text)
+        if match is None:
+            raise ValueError("not a SAN move: " + repr(san))
+        piece, fromFile, fromRank, target, promotion = match.groups()
+        piece = piece or "p"
+        endRow = chessEngine.Move.ranksToRows[target[1]]
+        endCol = chessEngine.Move.filesToCols[target[0]]
+        matches = [move for move in moves if move.pieceMoved[1] == piece and move.endRow == endRow and
+                   move.endCol == endCol and not move.isCastleMove and
+                   (fromFile is None or move.startCol == chessEngine.Move.filesToCols[fromFile]) and
+                   (fromRank is None or move.startRow == chessEngine.Move.ranksToRows[fromRank]) and
+                   (not move.isPawnPromotion or move.promotionChoice == (promotion or "Q"))]
+    if len(matches) != 1:
+        raise ValueError("%s SAN move %r in %s" % ("ambiguous" if matches else "illegal", san, gs.getFen()))
+    return matches[0]
+
+
+def readPgnGames(lines):
+    '''Yield (tags, [SAN moves], result) for every game of a PGN text, read lazily line by line.
+    Comments, variations and annotation glyphs are skipped'''
+    tags = {}
+    movetext = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("["):
+            if movetext: # a tag after movetext starts the next game, even without a result token
+                yield finishPgnGame(tags, movetext)
+                tags, movetext = {}, []
+            match = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if match:
+                tags[match.group(1)] = match.group(2)
+        elif line:
+            movetext.append(line)
+            if line.split()[-1] in RESULTS:
+                yield finishPgnGame(tags, movetext)
+                tags, movetext = {}, []
+    if movetext:
+        yield finishPgnGame(tags, movetext)
+
+
+def finishPgnGame(tags, movetext):
+    text = " ".join(movetext)
+    while True: # nested variations are removed from the inside out
+        stripped = re.sub(r"\([^()]*\)", " ", text)
+        if stripped == text:
+            break
+        text = stripped
+    moves = []
+    result = tags.get("Result", "*")
+    for token in PGN_TOKEN.findall(text):
+        if token[0] in "{;$(" or token[0].isdigit() and token.rstrip(".").isdigit():
+            continue
+        if token in RESULTS:
+            result = token
+            continue
+        moves.append(token)
+    return tags, moves, result
+
+
+def countBookMoves(games, plies=20, counts=None):
+    '''Add up how often each (zobrist key, packed move) was played in the first plies of the games.
+    A game with a move that cannot be read contributes the moves before it. Returns (counts, games, errors)'''
+    counts = {} if counts is None else counts
+    played = errors = 0
+    for tags, moves, result in games:
+        gs = chessEngine.GameState(tags.get("FEN"))
+        played += 1
+        for san in moves[:plies]:
+            try:
+                move = parseSan(gs, san)
+            except ValueError:
+                errors += 1
+                break
+            entry = (gs.zobristKey, move.code)
+            counts[entry] = counts.get(entry, 0) + 1
+            gs.makeMove(move)
+    return counts, played, errors
+
+
+def writeBook(path, counts, minGames=1):
+    '''Write the counted moves as a book, sorted by key. Returns the number of records'''
+    records = sorted((key, code, min(count, MAX_WEIGHT)) for (key, code), count in counts.items() if count >= minGames)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(BOOK_MAGIC, len(records)))
+        for record in records:
+            f.write(RECORD.pack(*record))
+    return len(records)
+
+
+class OpeningBook():
+    '''Read-only view of a book file. Nothing is read up front, lookups touch only the pages they search'''
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self.data, 0)
+        if magic != BOOK_MAGIC or len(self.data) != HEADER.size + self.size * RECORD.size:
+            self.close()
+            raise ValueError("not an opening book: " + repr(path))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def keyAt(self, index):
+        return struct.unpack_from(">Q", self.data, HEADER.size + index * RECORD.size)[0]
+
+    def entries(self, key):
+        '''[(packed move, weight)] stored for a zobrist key'''
+        low, high = 0, self.size
+        while low < high: # first record with a key >= key
+            middle = (low + high) >> 1
+            if self.keyAt(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        offset = HEADER.size + low * RECORD.size
+        while low < self.size:
+            recordKey, code, weight = RECORD.unpack_from(self.data, offset)
+            if recordKey != key:
+                break
+            found.append((code, weight))
+            low += 1
+            offset += RECORD.size
+        return found
+
+    def candidates(self, gs):
+        '''[(Move, weight)] of the book moves for the position of gs, heaviest first.
+        Only valid moves are returned, in case of a hash collision'''
+        valid = {move.code: move for move in gs.getValidMoves()}
+        found = [(valid[code], weight) for code, weight in self.entries(gs.zobristKey) if code in valid]
+        found.sort(key=lambda candidate: candidate[1], reverse=True)
+        return found
+
+    def chooseMove(self, gs, rng=random):
+        '''A book move picked at random in proportion to its weight, None when the position is out of book'''
+        found = [(move, weight) for move, weight in self.candidates(gs) if weight > 0]
+        if not found:
+            return None
+        return rng.choices([move for move, weight in found], [weight for move, weight in found])[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query an opening book")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="compile PGN files into a book")
+    build.add_argument("pgn", nargs="+")
+    build.add_argument("-o", "--output", required=True)
+    build.add_argument("--plies", type=int, default=20, help="plies of every game to include")
+    build.add_argument("--min-games", type=int, default=1, help="leave out moves played in fewer games")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book")
+    probe.add_argument("--fen", help="position to look up, default is the start position")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        counts = {}
+        games = errors = 0
+        for path in args.pgn:
+            with open(path, errors="replace") as f:
+                counts, played, failed = countBookMoves(readPgnGames(f), args.plies, counts)
+            games += played
+            errors += failed
+        records = writeBook(args.output, counts, args.min_games)
+        print("%d games, %d unreadable, %d book records written to %s" % (games, errors, records, args.output))
+    else:
+        with OpeningBook(args.book) as book:
+            for move, weight in book.candidates(chessEngine.GameState(args.fen)):
+                print(move.getChessNotation(), weight)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,13 +3,127 @@ Stores all the current information about the current gamestate
 Determines the valid moves at the current state. 
 It will also keep a move log.
 """
+from array import array
+import random
+import chessProfile
+from chessEvaluation import MATERIAL, MIDDLEGAME_SCORES, ENDGAME_SCORES, PHASE
+
+# Squares are numbered 0..63 as row*8 + col, so square 0 is a8 and square 63 is h1.
+# Every bitboard is a python int with bit `sq` set for each occupied square.
+PIECES = ["wp", "wN", "wB", "wR", "wQ", "wK", "bp", "bN", "bB", "bR", "bQ", "bK"]
+# small integer per piece for compact encodings, 0 is an empty square
+CODE_PIECES = ["--"] + PIECES
+PIECE_CODES = {piece: code for code, piece in enumerate(CODE_PIECES)}
+
+ROOK_DIRECTIONS = [(1,0),(-1,0),(0,1),(0,-1)]
+BISHOP_DIRECTIONS = [(1,1),(1,-1),(-1,1),(-1,-1)]
+QUEEN_DIRECTIONS = BISHOP_DIRECTIONS + ROOK_DIRECTIONS
+
+
+# A move packs into 16 bits: start square in bits 0-5, end square in bits 6-11 and a flag in bits 12-15
+FLAG_NONE = 0
+FLAG_CASTLE = 1
+FLAG_EN_PASSANT = 2
+FLAG_PROMOTION = 8 # promotions use FLAG_PROMOTION + the index of the new piece in PROMOTION_PIECES
+PROMOTION_PIECES = "NBRQ"
+MAX_MOVES = 256 # no position has more legal moves than this
+# castling rights packed into 4 bits, see CastleRights.bits
+CASTLE_WKS = 1
+CASTLE_BKS = 2
+CASTLE_WQS = 4
+CASTLE_BQS = 8
+# rights kept by a move from or to each square: moving a king or rook, or capturing a rook, ends its rights
+CASTLE_MASKS = [15] * 64
+CASTLE_MASKS[60] = 15 & ~(CASTLE_WKS | CASTLE_WQS)
+CASTLE_MASKS[63] = 15 & ~CASTLE_WKS
+CASTLE_MASKS[56] = 15 & ~CASTLE_WQS
+CASTLE_MASKS[4] = 15 & ~(CASTLE_BKS | CASTLE_BQS)
+CASTLE_MASKS[7] = 15 & ~CASTLE_BKS
+CASTLE_MASKS[0] = 15 & ~CASTLE_BQS
+
+# What a move cannot recompute on undo is packed into one int per ply on GameState.stateStack:
+# castling rights in bits 0-3, en passant square + 1 in bits 4-10, captured piece code in bits 11-14
+# and the halfmove clock from bit 15 up
+STATE_EN_PASSANT_SHIFT = 4
+STATE_CAPTURED_SHIFT = 11
+STATE_HALFMOVE_SHIFT = 15
+STATE_STACK_SIZE = 512 # plies allocated up front, the stack doubles when a game gets longer
+
+
+def newMoveBuffer():
+    '''Preallocated buffer for the packed moves of one position, e.g. one per search ply'''
+    return array('H', bytes(2*MAX_MOVES))
+
+
+def buildLeaperTable(offsets):
+    '''Bitboard of the squares reachable by a single jump from every square'''
+    table = []
+    for sq in range(64):
+        r, c = sq >> 3, sq & 7
+        mask = 0
+        for dr, dc in offsets:
+            if 0 <= r+dr <= 7 and 0 <= c+dc <= 7:
+                mask |= 1 << ((r+dr)*8 + c+dc)
+        table.append(mask)
+    return table
+
+
+def buildRayTable(dr, dc):
+    '''Bitboard of the open ray leaving every square in the direction (dr, dc)'''
+    table = []
+    for sq in range(64):
+        r, c = (sq >> 3) + dr, (sq & 7) + dc
+        mask = 0
+        while 0 <= r <= 7 and 0 <= c <= 7:
+            mask |= 1 << (r*8 + c)
+            r, c = r + dr, c + dc
+        table.append(mask)
+    return table
+
+
+KNIGHT_ATTACKS = buildLeaperTable([(2,1),(2,-1),(-1,2),(1,2),(-2,1),(-2,-1),(-1,-2),(1,-2)])
+KING_ATTACKS = buildLeaperTable([(-1,0),(-1,1),(-1,-1),(0,-1),(0,1),(1,0),(1,-1),(1,1)])
+PAWN_ATTACKS = {"w": buildLeaperTable([(-1,-1),(-1,1)]), "b": buildLeaperTable([(1,-1),(1,1)])}
+PAWN_PUSHES = {"w": buildLeaperTable([(-1,0)]), "b": buildLeaperTable([(1,0)])}
+# the two square advance, only from the starting row
+PAWN_DOUBLE_PUSHES = {"w": [1 << (sq-16) if sq >> 3 == 6 else 0 for sq in range(64)],
+                      "b": [1 << (sq+16) if sq >> 3 == 1 else 0 for sq in range(64)]}
+# rays that run towards higher square numbers stop at their lowest blocker, the others at their highest
+RAYS = {d: (buildRayTable(d[0], d[1]), d[0] > 0 or (d[0] == 0 and d[1] > 0)) for d in QUEEN_DIRECTIONS}
+
+
+# Zobrist keys. The generator is seeded so that keys, and anything stored by key, are the same in every process
+zobristRandom = random.Random(20240323)
+ZOBRIST_PIECES = {piece: [zobristRandom.getrandbits(64) for sq in range(64)] for piece in PIECES}
+ZOBRIST_BLACK_TO_MOVE = zobristRandom.getrandbits(64)
+ZOBRIST_CASTLING = [zobristRandom.getrandbits(64) for rights in range(16)] # indexed by GameState.castlingRights
+ZOBRIST_EN_PASSANT_FILE = [zobristRandom.getrandbits(64) for col in range(8)]
+
+
+def slidingAttacks(sq, directions, occupied):
+    '''Squares a slider on sq attacks along the given directions, up to and including the first blocker'''
+    attacks = 0
+    for d in directions:
+        table, positive = RAYS[d]
+        ray = table[sq]
+        blockers = ray & occupied
+        if blockers:
+            if positive:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= table[blocker]
+        attacks |= ray
+    return attacks
+
+
 class GameState():
-    def __init__(self):
+    def __init__(self, fen=None):
         # board is a 8x8 2d list. Each element in the list has 2 characters
         # first charcter represents the colour of the pieace. "b" or "w"
         # second character represents the type of the piece.
         # "--" represents an empty space.
-        self.board = [
+        board = [
             ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
             ["bp", "bp", "bp", "bp", "bp", "bp", "bp", "bp"],
             ["--", "--", "--", "--", "--", "--", "--", "--"],
@@ -19,113 +133,494 @@ class GameState():
             ["wp", "wp", "wp", "wp", "wp", "wp", "wp", "wp"],
             ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]
         ]
-        self.moveFunctions = {'p': self.getPawnMoves, 'R': self.getRookMoves, 'N': self.getKnightMoves,
-                              'B': self.getBishopMoves, 'Q': self.getQueenMoves, 'K': self.getKingMoves}
+        # generate legal moves directly from checks and pins. Set to False to fall back to
+        # playing every pseudo-legal move and filtering with inCheck, e.g. to cross-check the two
+        self.useLegalMoveGenerator = True
+        self.loadBoard(board)
         self.whiteToMove = True
+        self.castlingRights = CASTLE_WKS | CASTLE_BKS | CASTLE_WQS | CASTLE_BQS # ath the start, no rule is broken
+        self.enpassantSquare = -1 # square a pawn can capture onto en passant, -1 if there is none
+        self.halfmoveClock = 0 # plies since the last capture or pawn move, for the fifty-move rule
+        self.fullmoveNumber = 1 # move number of the position the history starts from
+        if fen is not None:
+            self.loadFen(fen)
+        self.resetHistory()
+
+    def resetHistory(self):
+        '''Start the move logs and the repetition history again from the current position'''
         self.moveLog = []
+        # packed code of every move played, including search moves that never reach moveLog,
+        # and the packed state before each of them at the same index of stateStack
+        self.codeLog = []
+        self.stateStack = array('Q', bytes(8*STATE_STACK_SIZE))
+        self.validMovesCache = None # (key, moves, in check) of the last position getValidMoves was asked about
+        # zobrist key of every position reached so far, and how often each occurred, for repetition checks
+        self.zobristKey = self.computeZobristKey()
+        self.keyHistory = [self.zobristKey]
+        self.keyCounts = {self.zobristKey: 1}
+        self.rebuildAttackMaps()
+
+    def loadFen(self, fen):
+        '''Set up the position from a FEN string. Call resetHistory afterwards unless done from __init__'''
+        fields = fen.split()
+        rows = fields[0].split("/") if fields else []
+        if len(rows) != 8:
+            raise ValueError("FEN must describe 8 ranks: " + repr(fen))
+        board = []
+        for row in rows:
+            line = []
+            for char in row:
+                if char in "12345678":
+                    line.extend(["--"] * int(char))
+                elif char.upper() in "PNBRQK":
+                    line.append(("w" if char.isupper() else "b") + (char.upper() if char.upper() != "P" else "p"))
+                else:
+                    raise ValueError("unknown piece " + repr(char) + " in FEN " + repr(fen))
+            if len(line) != 8:
+                raise ValueError("FEN rank " + repr(row) + " does not have 8 squares")
+            board.append(line)
+        if sum(line.count("wK") for line in board) != 1 or sum(line.count("bK") for line in board) != 1:
+            raise ValueError("FEN must have exactly one king per side: " + repr(fen))
+        if len(fields) > 1 and fields[1] not in ("w", "b"):
+            raise ValueError("the side to move must be w or b in FEN " + repr(fen))
+        whiteToMove = len(fields) < 2 or fields[1] == "w"
+        enpassantSquare = -1
+        if len(fields) > 3 and fields[3] != "-":
+            # the square a pawn just passed: rank 6 with white to move, rank 3 with black, the pawn in front of it
+            square = fields[3]
+            if len(square) != 2 or square[0] not in Move.filesToCols or square[1] != ("6" if whiteToMove else "3"):
+                raise ValueError("bad en passant square " + repr(square) + " in FEN " + repr(fen))
+            r, c = Move.ranksToRows[square[1]], Move.filesToCols[square[0]]
+            pawnRow = r + 1 if whiteToMove else r - 1
+            if board[r][c] != "--" or board[pawnRow][c] != ("bp" if whiteToMove else "wp"):
+                raise ValueError("no pawn can be taken en passant on " + repr(square) + " in FEN " + repr(fen))
+            enpassantSquare = r*8 + c
+        self.loadBoard(board)
+        self.whiteToMove = whiteToMove
+        # a right is only kept if the king and rook are still on their home squares
+        castling = fields[2] if len(fields) > 2 else "-"
+        self.castlingRights = CastleRights(
+            "K" in castling and board[7][4] == "wK" and board[7][7] == "wR",
+            "k" in castling and board[0][4] == "bK" and board[0][7] == "bR",
+            "Q" in castling and board[7][4] == "wK" and board[7][0] == "wR",
+            "q" in castling and board[0][4] == "bK" and board[0][0] == "bR").bits()
+        self.enpassantSquare = enpassantSquare
+        self.halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmoveNumber = max(1, int(fields[5])) if len(fields) > 5 else 1
+
+    def getFen(self):
+        '''The current position as a FEN string, the inverse of loadFen'''
+        rows = []
+        for r in range(8):
+            row = ""
+            empty = 0
+            for piece in self.squares[r*8:r*8+8]:
+                if piece == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += piece[1].upper() if piece[0] == "w" else piece[1].lower()
+            rows.append(row + (str(empty) if empty else ""))
+        rights = self.castlingRights
+        castling = ("K" if rights & CASTLE_WKS else "") + ("Q" if rights & CASTLE_WQS else "") + \
+                   ("k" if rights & CASTLE_BKS else "") + ("q" if rights & CASTLE_BQS else "")
+        enpassant = "-"
+        if self.enpassantSquare != -1:
+            enpassant = Move.colsToFiles[self.enpassantSquare & 7] + Move.rowsToRanks[self.enpassantSquare >> 3]
+        # the move number goes up after every black move since the history started
+        plies = len(self.codeLog)
+        startedWithBlack = self.whiteToMove == (plies % 2 == 1)
+        fullmove = self.fullmoveNumber + (plies + startedWithBlack) // 2
+        return "%s %s %s %s %d %d" % ("/".join(rows), "w" if self.whiteToMove else "b", castling or "-",
+                                      enpassant, self.halfmoveClock, fullmove)
+
+    def encodePosition(self):
+        '''The position as 34 bytes: a 4-bit piece code per square, then side to move with castling rights,
+        then the en passant square. Cheap to pickle, e.g. to send to worker processes'''
+        data = bytearray(34)
+        squares = self.squares
+        for sq in range(0, 64, 2):
+            data[sq >> 1] = PIECE_CODES[squares[sq]] | PIECE_CODES[squares[sq+1]] << 4
+        data[32] = (not self.whiteToMove) | self.castlingRights << 1
+        data[33] = self.enpassantSquare + 1
+        return bytes(data)
+
+    @classmethod
+    def decodePosition(cls, data):
+        '''New GameState from the output of encodePosition. The game history is not part of the encoding'''
+        gs = cls()
+        squares = []
+        for byte in data[:32]:
+            squares.append(CODE_PIECES[byte & 15])
+            squares.append(CODE_PIECES[byte >> 4])
+        gs.loadBoard([squares[r*8:r*8+8] for r in range(8)])
+        gs.whiteToMove = not data[32] & 1
+        gs.castlingRights = data[32] >> 1
+        gs.enpassantSquare = data[33] - 1
+        gs.resetHistory()
+        return gs
+
+    def loadBoard(self, board):
+        '''Set up the bitboards and the square list from an 8x8 list of piece strings'''
+        # one bitboard per piece type and colour, plus occupancy masks
+        self.pieceBitboards = {piece: 0 for piece in PIECES}
+        self.colorBitboards = {"w": 0, "b": 0}
+        self.occupied = 0
+        # squares[sq] is the piece on sq, so a capture can be identified without scanning the bitboards
+        self.squares = ["--"] * 64
+        self.boardView = None
+        self.zobristKey = 0
+        # running evaluation terms, white positive, see chessEvaluation
+        self.material = 0
+        self.middlegameScore = 0
+        self.endgameScore = 0
+        self.phase = 0
+        for r in range(8):
+            for c in range(8):
+                if board[r][c] != "--":
+                    self.placePiece(board[r][c], r*8 + c)
         # store king's position
-        self.whiteKingPosition = (7,4)
-        self.blackKingPosition = (0,4)
-        self.checkMate = False
-        self.staleMate = False
-        self.currentCastlingRights = CastleRights(True, True, True, True) # ath the start, no rule is broken
-        self.castleRightsLog = [CastleRights(self.currentCastlingRights.wks,self.currentCastlingRights.bks,
-                                             self.currentCastlingRights.wqs,self.currentCastlingRights.bqs)]
+        whiteKing = self.pieceBitboards["wK"].bit_length() - 1
+        blackKing = self.pieceBitboards["bK"].bit_length() - 1
+        self.whiteKingPosition = (whiteKing >> 3, whiteKing & 7)
+        self.blackKingPosition = (blackKing >> 3, blackKing & 7)
+
+    def computeZobristKey(self):
+        '''Zobrist key of the position computed from scratch. makeMove/undoMove keep self.zobristKey equal to this'''
+        key = 0
+        for sq in range(64):
+            if self.squares[sq] != "--":
+                key ^= ZOBRIST_PIECES[self.squares[sq]][sq]
+        if not self.whiteToMove:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        if self.enpassantSquare != -1:
+            key ^= ZOBRIST_EN_PASSANT_FILE[self.enpassantSquare & 7]
+        return key ^ ZOBRIST_CASTLING[self.castlingRights]
+
+    def getProfileStats(self):
+        '''Calls, time and allocations of the instrumented engine and render functions, see chessProfile.
+        Only filled while chessProfile.PROFILER is enabled'''
+        return chessProfile.PROFILER.getStats()
+
+    def repetitionCount(self):
+        '''How many times the current position has occurred in the game, including now'''
+        return self.keyCounts[self.zobristKey]
+
+    def isFiftyMoveDraw(self):
+        '''True once fifty moves by each side were played without a capture or pawn move'''
+        return self.halfmoveClock >= 100
+
+    @property
+    def board(self):
+        '''8x8 list-of-strings view of the position, rebuilt from the bitboard state after every change.
+        It is a read-only snapshot: writing to it does not change the game'''
+        if self.boardView is None:
+            squares = self.squares
+            self.boardView = [squares[i:i+8] for i in range(0, 64, 8)]
+        return self.boardView
+
+    def placePiece(self, piece, sq):
+        bit = 1 << sq
+        self.pieceBitboards[piece] ^= bit
+        self.colorBitboards[piece[0]] ^= bit
+        self.occupied ^= bit
+        self.squares[sq] = piece
+        self.zobristKey ^= ZOBRIST_PIECES[piece][sq]
+        self.material += MATERIAL[piece]
+        self.middlegameScore += MIDDLEGAME_SCORES[piece][sq]
+        self.endgameScore += ENDGAME_SCORES[piece][sq]
+        self.phase += PHASE[piece]
+
+    def removePiece(self, piece, sq):
+        bit = 1 << sq
+        self.pieceBitboards[piece] ^= bit
+        self.colorBitboards[piece[0]] ^= bit
+        self.occupied ^= bit
+        self.squares[sq] = "--"
+        self.zobristKey ^= ZOBRIST_PIECES[piece][sq]
+        self.material -= MATERIAL[piece]
+        self.middlegameScore -= MIDDLEGAME_SCORES[piece][sq]
+        self.endgameScore -= ENDGAME_SCORES[piece][sq]
+        self.phase -= PHASE[piece]
 
     def makeMove(self, move):
-        if self.board[move.startRow][move.startCol] != "--": # first cell shold not be an empty cell
-            self.board[move.startRow][move.startCol] = "--"
-            self.board[move.endRow][move.endCol] = move.pieceMoved
+        if self.squares[move.startRow*8 + move.startCol] != "--": # first cell shold not be an empty cell
+            tracked = self.attackMapsKey == self.zobristKey
+            self.makePackedMove(move.code)
             self.moveLog.append(move)
-            self.whiteToMove = not self.whiteToMove # swap players
-
-            if move.pieceMoved == "wK":
-                self.whiteKingPosition = (move.endRow, move.endCol)
-            elif move.pieceMoved == "bK":
-                self.blackKingPosition = (move.endRow, move.endCol)
-
-            # pawn promotion
-            if move.isPawnPromotion:
-                self.board[move.endRow][move.endCol] = move.pieceMoved[0] + 'Q'
-
-            if move.isCastleMove:
-                if move.endCol - move.startCol == 2:
-                    self.board[move.endRow][move.endCol-1] = self.board[move.endRow][move.endCol+1]
-                    self.board[move.endRow][move.endCol+1] = "--"
-                else:
-                    self.board[move.endRow][move.endCol+1] = self.board[move.endRow][move.endCol-2]
-                    self.board[move.endRow][move.endCol-2] = "--" 
+            if tracked:
+                self.updateAttackMaps(self.changedSquares(move.code))
 
+    def undoMove(self):
+        if len(self.moveLog) != 0: # make sure there is a move to undo
+            tracked = self.attackMapsKey == self.zobristKey
+            code = self.codeLog[-1]
+            self.moveLog.pop()
+            self.undoPackedMove()
+            if tracked:
+                self.updateAttackMaps(self.changedSquares(code))
+
+    def changedSquares(self, code):
+        '''Bitboard of the squares whose contents a packed move changes'''
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12
+        changed = 1 << start | 1 << end
+        if flag == FLAG_EN_PASSANT:
+            changed |= 1 << ((start & 56) | (end & 7))
+        elif flag == FLAG_CASTLE:
+            changed |= 0b101 << (end - 1) if end > start else 0b1001 << (end - 2) # the rook's start and end squares
+        return changed
+
+    def pieceAttacks(self, sq):
+        '''Bitboard of the squares attacked by the piece on sq'''
+        piece = self.squares[sq]
+        kind = piece[1]
+        if kind == 'p':
+            return PAWN_ATTACKS[piece[0]][sq]
+        if kind == 'N':
+            return KNIGHT_ATTACKS[sq]
+        if kind == 'K':
+            return KING_ATTACKS[sq]
+        if kind == 'R':
+            return slidingAttacks(sq, ROOK_DIRECTIONS, self.occupied)
+        if kind == 'B':
+            return slidingAttacks(sq, BISHOP_DIRECTIONS, self.occupied)
+        return slidingAttacks(sq, QUEEN_DIRECTIONS, self.occupied)
+
+    def rebuildAttackMaps(self):
+        '''Recompute the attack maps from scratch. attackCounts[color][sq] is how many pieces of that colour
+        attack sq, attackSets[sq] the squares attacked by the piece on sq and attackColors[sq] its colour.
+        makeMove/undoMove keep them up to date,
+        moves made with makePackedMove alone leave them stale until the next query'''
+        self.attackCounts = {"w": [0] * 64, "b": [0] * 64}
+        self.attackSets = [0] * 64
+        self.attackColors = [None] * 64
+        self.attackMapsKey = self.zobristKey
+        self.updateAttackMaps(self.occupied)
+
+    def updateAttackMaps(self, changed):
+        '''Bring the attack maps up to date after the contents of the `changed` squares changed.
+        Only the pieces on those squares and the sliders whose lines run into them are recomputed'''
+        pieceBitboards = self.pieceBitboards
+        affected = changed
+        sliders = (pieceBitboards["wR"] | pieceBitboards["wB"] | pieceBitboards["wQ"] |
+                   pieceBitboards["bR"] | pieceBitboards["bB"] | pieceBitboards["bQ"]) & ~changed
+        while sliders:
+            bit = sliders & -sliders
+            sliders ^= bit
+            if self.attackSets[bit.bit_length() - 1] & changed:
+                affected |= bit
+        counts = self.attackCounts
+        while affected:
+            bit = affected & -affected
+            affected ^= bit
+            sq = bit.bit_length() - 1
+            attacks = self.attackSets[sq]
+            if attacks: # take away what the old piece on sq attacked
+                colorCounts = counts[self.attackColors[sq]]
+                while attacks:
+                    target = attacks & -attacks
+                    attacks ^= target
+                    colorCounts[target.bit_length() - 1] -= 1
+            if self.squares[sq] == "--":
+                self.attackSets[sq] = 0
+                continue
+            attacks = self.pieceAttacks(sq)
+            color = self.squares[sq][0]
+            self.attackSets[sq] = attacks
+            self.attackColors[sq] = color
+            colorCounts = counts[color]
+            while attacks:
+                target = attacks & -attacks
+                attacks ^= target
+                colorCounts[target.bit_length() - 1] += 1
+        self.attackMapsKey = self.zobristKey
+
+    def computeAttackCounts(self):
+        '''Attack counts of both colours recomputed from scratch with attackersBitboard, to cross-check the maps'''
+        return {color: [bin(self.attackersBitboard(sq, color, self.occupied)).count("1") for sq in range(64)]
+                for color in "wb"}
+
+    def attackCount(self, square, color):
+        '''How many pieces of the given colour attack square (row, col). O(1) while the maps are up to date'''
+        if self.attackMapsKey != self.zobristKey:
+            self.rebuildAttackMaps()
+        return self.attackCounts[color][square[0]*8 + square[1]]
+
+    def makePackedMove(self, code):
+        '''Play a move given in the packed 16-bit format. Search uses this pair directly, so no Move object is needed'''
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12
+        piece = self.squares[start]
+        # an en passant capture takes the pawn beside the start square, not on the end square
+        capturedSq = (start & 56) | (end & 7) if flag == FLAG_EN_PASSANT else end
+        captured = self.squares[capturedSq]
+        self.boardView = None
+        self.removePiece(piece, start)
+        if captured != "--":
+            self.removePiece(captured, capturedSq)
+        # pawn promotion
+        if flag >= FLAG_PROMOTION:
+            self.placePiece(piece[0] + PROMOTION_PIECES[flag - FLAG_PROMOTION], end)
+        else:
+            self.placePiece(piece, end)
+        # save what undo cannot work out from the move itself
+        ply = len(self.codeLog)
+        if ply == len(self.stateStack):
+            self.stateStack.frombytes(bytes(8*ply))
+        self.stateStack[ply] = self.castlingRights | (self.enpassantSquare + 1) << STATE_EN_PASSANT_SHIFT | \
+                               PIECE_CODES[captured] << STATE_CAPTURED_SHIFT | self.halfmoveClock << STATE_HALFMOVE_SHIFT
+        self.codeLog.append(code)
+        self.halfmoveClock = 0 if piece[1] == 'p' or captured != "--" else self.halfmoveClock + 1
+        self.whiteToMove = not self.whiteToMove # swap players
+
+        # a two square pawn advance can be captured en passant on the next move only
+        if self.enpassantSquare != -1:
+            self.zobristKey ^= ZOBRIST_EN_PASSANT_FILE[self.enpassantSquare & 7]
+        if piece[1] == 'p' and (end - start == 16 or start - end == 16):
+            self.enpassantSquare = (start + end) >> 1
+            self.zobristKey ^= ZOBRIST_EN_PASSANT_FILE[end & 7]
+        else:
+            self.enpassantSquare = -1
+
+        if piece == "wK":
+            self.whiteKingPosition = (end >> 3, end & 7)
+        elif piece == "bK":
+            self.blackKingPosition = (end >> 3, end & 7)
+
+        if flag == FLAG_CASTLE:
+            rook = piece[0] + 'R'
+            if end > start: # king side
+                self.removePiece(rook, end+1)
+                self.placePiece(rook, end-1)
+            else:
+                self.removePiece(rook, end-2)
+                self.placePiece(rook, end+1)
+
+        # update calstling rights
+        oldRights = self.castlingRights
+        self.updateCastleRights(start, end)
+        if self.castlingRights != oldRights:
+            self.zobristKey ^= ZOBRIST_CASTLING[oldRights] ^ ZOBRIST_CASTLING[self.castlingRights]
+
+        self.zobristKey ^= ZOBRIST_BLACK_TO_MOVE
+        self.keyHistory.append(self.zobristKey)
+        self.keyCounts[self.zobristKey] = self.keyCounts.get(self.zobristKey, 0) + 1
+
+    def undoPackedMove(self):
+        '''Take back the last move played with makePackedMove'''
+        code = self.codeLog.pop()
+        state = self.stateStack[len(self.codeLog)]
+        captured = CODE_PIECES[state >> STATE_CAPTURED_SHIFT & 15]
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12
+        self.boardView = None
+        piece = self.squares[end]
+        self.removePiece(piece, end)
+        if flag >= FLAG_PROMOTION:
+            piece = piece[0] + 'p'
+        self.placePiece(piece, start)
+        if captured != "--":
+            self.placePiece(captured, (start & 56) | (end & 7) if flag == FLAG_EN_PASSANT else end)
+        self.whiteToMove = not self.whiteToMove # swap players
+        self.enpassantSquare = (state >> STATE_EN_PASSANT_SHIFT & 127) - 1
+        self.halfmoveClock = state >> STATE_HALFMOVE_SHIFT
+        self.castlingRights = state & 15
+
+        if piece == "wK":
+            self.whiteKingPosition = (start >> 3, start & 7)
+        elif piece == "bK":
+            self.blackKingPosition = (start >> 3, start & 7)
+
+        # undo the castle moves
+        if flag == FLAG_CASTLE:
+            rook = piece[0] + 'R'
+            if end > start: # king side
+                self.removePiece(rook, end-1)
+                self.placePiece(rook, end+1)
+            else:
+                self.removePiece(rook, end+1)
+                self.placePiece(rook, end-2)
 
-            # update calstling rights
-            self.updateCastleRights(move)
-            self.castleRightsLog.append(CastleRights(self.currentCastlingRights.wks,self.currentCastlingRights.bks,
-                                                     self.currentCastlingRights.wqs,self.currentCastlingRights.bqs))
+        # the piece updates above already toggled their keys back, the history restores the rest
+        key = self.keyHistory.pop()
+        if self.keyCounts[key] == 1:
+            del self.keyCounts[key]
+        else:
+            self.keyCounts[key] -= 1
+        self.zobristKey = self.keyHistory[-1]
 
-            
+    def updateCastleRights(self, start, end):
+        '''update the castle right given the start and end squares of a move'''
+        # a move from or to a king or rook home square means that piece has moved or been captured
+        self.castlingRights &= CASTLE_MASKS[start] & CASTLE_MASKS[end]
 
-    def undoMove(self):
-        if len(self.moveLog) != 0: # make sure there is a move to undo
-            move = self.moveLog.pop()
-            self.board[move.startRow][move.startCol] = move.pieceMoved
-            self.board[move.endRow][move.endCol] = move.pieceCaptured
-            self.whiteToMove = not self.whiteToMove # swap players
-
-            if move.pieceMoved == "wK":
-                self.whiteKingPosition = (move.startRow, move.startCol)
-            elif move.pieceMoved == "bK":
-                self.blackKingPosition = (move.startRow, move.startCol)
-
-            # undo the castling rights
-            self.castleRightsLog.pop()
-            self.currentCastlingRights = self.castleRightsLog[-1]
-
-            # undo the castle moves
-            if move.isCastleMove:
-                if move.endCol - move.startCol == 2:
-                    self.board[move.endRow][move.endCol+1] = self.board[move.endRow][move.endCol-1]
-                    self.board[move.endRow][move.endCol-1] = "--"
-                else:
-                    self.board[move.endRow][move.endCol-2] = self.board[move.endRow][move.endCol+1]
-                    self.board[move.endRow][move.endCol+1] = "--" 
-
-    def updateCastleRights(self,move):
-        '''update the castle right given the move'''
-        if move.pieceMoved == "wK":
-            self.currentCastlingRights.wks = False
-            self.currentCastlingRights.wqs = False
-        if move.pieceMoved == "bK":
-            self.currentCastlingRights.bks = False
-            self.currentCastlingRights.bqs = False
-
-        if move.pieceMoved == "wR":
-            if move.startRow == 7:
-                if move.startCol == 7: # right rook
-                    self.currentCastlingRights.wks = False
-                if move.startCol == 0: # right rook
-                    self.currentCastlingRights.wqs = False
-        if move.pieceMoved == "bR":
-            if move.startRow == 0:
-                if move.startCol == 7: # right rook
-                    self.currentCastlingRights.bks = False
-                if move.startCol == 0: # right rook
-                    self.currentCastlingRights.bqs = False
-                
     def getAllPosiibleMoves(self):
         '''All possible moves without considering checks'''
         moves =[]
-        for r in range(len(self.board)):
-            for c in range(len(self.board[r])):
-                turn = self.board[r][c][0]
-                if (turn == "w" and self.whiteToMove) or (turn == "b" and not self.whiteToMove):
-                    piece = self.board[r][c][1]
-                    self.moveFunctions[piece](r, c, moves)
+        pieces = self.colorBitboards["w" if self.whiteToMove else "b"]
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            sq = bit.bit_length() - 1
+            self.moveFunctions[self.squares[sq][1]](self, sq >> 3, sq & 7, moves)
         return moves
     
     def getValidMoves(self):
         ''' All possible moves considering checks'''
-        tempCurrentCastlingRight = CastleRights(self.currentCastlingRights.wks,self.currentCastlingRights.bks,
-                                                       self.currentCastlingRights.wqs,self.currentCastlingRights.bqs)
+        return list(self.getCachedMoves()[0])
+
+    def getCachedMoves(self):
+        '''(valid moves, in check) of the current position, generated at most once per position.
+        Every move changes the zobrist key, so makeMove/undoMove invalidate the cache and it
+        comes back into use if the position returns. The list is shared, do not modify it'''
+        cacheKey = (self.zobristKey, self.useLegalMoveGenerator)
+        if self.validMovesCache is None or self.validMovesCache[0] != cacheKey:
+            if self.useLegalMoveGenerator:
+                moves = self.getLegalMoves()
+            else:
+                moves = self.getFilteredMoves()
+            self.validMovesCache = (cacheKey, moves, self.inCheck())
+        return self.validMovesCache[1], self.validMovesCache[2]
+
+    @property
+    def checkMate(self):
+        return self.isCheckmate()
+
+    @property
+    def staleMate(self):
+        return self.isStalemate()
+
+    @property
+    def currentCastlingRights(self):
+        '''The castling rights as a CastleRights object, a fresh copy of the packed self.castlingRights'''
+        return CastleRights.fromBits(self.castlingRights)
+
+    @currentCastlingRights.setter
+    def currentCastlingRights(self, rights):
+        self.castlingRights = rights.bits()
+
+    def isCheckmate(self):
+        moves, inCheck = self.getCachedMoves()
+        return len(moves) == 0 and inCheck
+
+    def isStalemate(self):
+        moves, inCheck = self.getCachedMoves()
+        return len(moves) == 0 and not inCheck
+
+    def checkSquare(self):
+        '''(row, col) of the king of the side to move if it is in check, otherwise None'''
+        if not self.inCheck():
+            return None
+        return self.whiteKingPosition if self.whiteToMove else self.blackKingPosition
+
+    def getFilteredMoves(self):
+        '''All possible moves considering checks, found by making every pseudo-legal move and testing for check'''
         # get all possible moves
         moves = self.getAllPosiibleMoves()
         if self.whiteToMove:
@@ -142,20 +637,152 @@ class GameState():
                 moves.remove(moves[i])
             self.whiteToMove = not self.whiteToMove
             self.undoMove()
-
-        if len(moves) == 0: # check mate or stale mate
-            if self.inCheck():
-                self.checkMate = True
-            else:
-                self.staleMate = True
-
-        else:
-            self.checkMate = False
-            self.staleMate = False
-
-        self.currentCastlingRights = tempCurrentCastlingRight
         return moves
     
+    def getLegalMoves(self):
+        '''All legal moves as Move objects, see getLegalMoveCodes'''
+        buffer = newMoveBuffer()
+        squares = self.squares
+        return [Move.fromCode(buffer[i], squares) for i in range(self.getLegalMoveCodes(buffer))]
+
+    def getLegalMoveCodes(self, buffer):
+        '''Write the packed legal moves into buffer (see newMoveBuffer) and return how many there are.
+        They are generated from the checkers and pinned pieces of the position without making any move'''
+        count = 0
+        color, opColor = ("w", "b") if self.whiteToMove else ("b", "w")
+        pieceBitboards = self.pieceBitboards
+        occupied = self.occupied
+        own = self.colorBitboards[color]
+        kingRow, kingCol = self.whiteKingPosition if self.whiteToMove else self.blackKingPosition
+        king = kingRow*8 + kingCol
+
+        # checkers and the squares that resolve a single check (capture the checker or block its line)
+        checkers = (KNIGHT_ATTACKS[king] & pieceBitboards[opColor+"N"]) | (PAWN_ATTACKS[color][king] & pieceBitboards[opColor+"p"])
+        evasions = checkers
+        # pinned square -> the line it may still move along, up to and including the pinning piece
+        pins = {}
+        rookSliders = pieceBitboards[opColor+"R"] | pieceBitboards[opColor+"Q"]
+        bishopSliders = pieceBitboards[opColor+"B"] | pieceBitboards[opColor+"Q"]
+        for direction in QUEEN_DIRECTIONS:
+            table, positive = RAYS[direction]
+            sliders = rookSliders if direction[0] == 0 or direction[1] == 0 else bishopSliders
+            ray = table[king]
+            if not ray & sliders:
+                continue
+            blockers = ray & occupied
+            first = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+            if sliders >> first & 1: # the first piece on the line gives check
+                checkers |= 1 << first
+                evasions |= ray ^ table[first]
+            elif own >> first & 1: # our piece may be pinned by the next piece behind it
+                blockers ^= 1 << first
+                if blockers:
+                    second = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+                    if sliders >> second & 1:
+                        pins[first] = ray ^ table[second]
+
+        # the king is lifted off the board so that it cannot hide behind itself from a slider
+        kingless = occupied ^ (1 << king)
+        targets = KING_ATTACKS[king] & ~own
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            sq = bit.bit_length() - 1
+            if not self.isSquareAttacked(sq, opColor, kingless):
+                buffer[count] = king | sq << 6
+                count += 1
+        if checkers & (checkers - 1): # double check, only the king can move
+            return count
+
+        enemy = self.colorBitboards[opColor]
+        enpassant = self.enpassantSquare
+        pieces = own ^ pieceBitboards[color+"K"]
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            sq = bit.bit_length() - 1
+            piece = self.squares[sq][1]
+            if piece == "p":
+                targets = PAWN_ATTACKS[color][sq] & enemy
+                push = PAWN_PUSHES[color][sq]
+                if not occupied & push: # one square pawn advance
+                    targets |= push
+                    if not occupied & PAWN_DOUBLE_PUSHES[color][sq]: # two square pawn advance
+                        targets |= PAWN_DOUBLE_PUSHES[color][sq]
+                if checkers:
+                    targets &= evasions
+                if sq in pins:
+                    targets &= pins[sq]
+                if sq >> 3 == (1 if color == "w" else 6): # a pawn reaching the last rank promotes to any of NBRQ
+                    while targets:
+                        bit = targets & -targets
+                        targets ^= bit
+                        move = sq | (bit.bit_length() - 1) << 6
+                        for promotion in range(FLAG_PROMOTION, FLAG_PROMOTION + 4):
+                            buffer[count] = move | promotion << 12
+                            count += 1
+                else:
+                    while targets:
+                        bit = targets & -targets
+                        targets ^= bit
+                        buffer[count] = sq | (bit.bit_length() - 1) << 6
+                        count += 1
+                if enpassant != -1 and PAWN_ATTACKS[color][sq] >> enpassant & 1:
+                    # both pawns leave the line they stood on, so check for sliders and checkers from scratch
+                    capturedSq = (sq & 56) | (enpassant & 7)
+                    after = occupied ^ (1 << sq) ^ (1 << capturedSq) ^ (1 << enpassant)
+                    if not checkers & ~(1 << capturedSq) & ~(rookSliders | bishopSliders) and \
+                            not slidingAttacks(king, ROOK_DIRECTIONS, after) & rookSliders and \
+                            not slidingAttacks(king, BISHOP_DIRECTIONS, after) & bishopSliders:
+                        buffer[count] = sq | enpassant << 6 | FLAG_EN_PASSANT << 12
+                        count += 1
+                continue
+            elif piece == "N":
+                targets = KNIGHT_ATTACKS[sq] & ~own
+            elif piece == "B":
+                targets = slidingAttacks(sq, BISHOP_DIRECTIONS, occupied) & ~own
+            elif piece == "R":
+                targets = slidingAttacks(sq, ROOK_DIRECTIONS, occupied) & ~own
+            else:
+                targets = slidingAttacks(sq, QUEEN_DIRECTIONS, occupied) & ~own
+            if checkers:
+                targets &= evasions
+            if sq in pins:
+                targets &= pins[sq]
+            while targets:
+                bit = targets & -targets
+                targets ^= bit
+                buffer[count] = sq | (bit.bit_length() - 1) << 6
+                count += 1
+
+        # castling: never out of check, and the king may not pass through an attacked square
+        if not checkers:
+            kingSide = self.castlingRights & (CASTLE_WKS if color == "w" else CASTLE_BKS)
+            queenSide = self.castlingRights & (CASTLE_WQS if color == "w" else CASTLE_BQS)
+            if kingSide and not occupied & (0b11 << (king+1)) and \
+                    not self.isSquareAttacked(king+1, opColor, occupied) and not self.isSquareAttacked(king+2, opColor, occupied):
+                buffer[count] = king | (king+2) << 6 | FLAG_CASTLE << 12
+                count += 1
+            if queenSide and not occupied & (0b111 << (king-3)) and \
+                    not self.isSquareAttacked(king-1, opColor, occupied) and not self.isSquareAttacked(king-2, opColor, occupied):
+                buffer[count] = king | (king-2) << 6 | FLAG_CASTLE << 12
+                count += 1
+        return count
+
+    def attackersBitboard(self, sq, color, occupied):
+        '''Bitboard of the pieces of the given colour that attack sq, with sliders blocked by `occupied`'''
+        pieceBitboards = self.pieceBitboards
+        # a white pawn attacks sq exactly when a black pawn on sq would attack the white pawn, and vice versa
+        attackers = (KNIGHT_ATTACKS[sq] & pieceBitboards[color+"N"]) | (KING_ATTACKS[sq] & pieceBitboards[color+"K"]) | \
+                    (PAWN_ATTACKS["b" if color == "w" else "w"][sq] & pieceBitboards[color+"p"])
+        rookSliders = pieceBitboards[color+"R"] | pieceBitboards[color+"Q"]
+        if rookSliders:
+            attackers |= slidingAttacks(sq, ROOK_DIRECTIONS, occupied) & rookSliders
+        bishopSliders = pieceBitboards[color+"B"] | pieceBitboards[color+"Q"]
+        if bishopSliders:
+            attackers |= slidingAttacks(sq, BISHOP_DIRECTIONS, occupied) & bishopSliders
+        return attackers
+
     def inCheck(self):
         '''Determines if the current player is in check'''
         if self.whiteToMove:
@@ -165,150 +792,127 @@ class GameState():
     
     def squareUnderAttack(self, r, c):
         '''Detrmines if the enemy can attack the current square'''
-        self.whiteToMove = not self.whiteToMove # switch to opponents turn
-
-        oppMoves = self.getAllPosiibleMoves()
-
-        self.whiteToMove = not self.whiteToMove # switch back to current turn
-
-        for move in oppMoves:
-            if move.endRow == r and move.endCol == c:
-                return True
+        if self.attackMapsKey == self.zobristKey: # a lookup while makeMove/undoMove keep the maps current
+            return self.attackCounts["b" if self.whiteToMove else "w"][r*8 + c] > 0
+        return self.isSquareAttacked(r*8 + c, "b" if self.whiteToMove else "w", self.occupied)
+
+    def isSquareAttacked(self, sq, color, occupied):
+        '''Looks outward from sq for a piece of the given colour attacking it, stopping at the first one found'''
+        pieceBitboards = self.pieceBitboards
+        if KNIGHT_ATTACKS[sq] & pieceBitboards[color+"N"] or KING_ATTACKS[sq] & pieceBitboards[color+"K"] or \
+                PAWN_ATTACKS["b" if color == "w" else "w"][sq] & pieceBitboards[color+"p"]:
+            return True
+        rookSliders = pieceBitboards[color+"R"] | pieceBitboards[color+"Q"]
+        bishopSliders = pieceBitboards[color+"B"] | pieceBitboards[color+"Q"]
+        for direction in QUEEN_DIRECTIONS:
+            sliders = rookSliders if direction[0] == 0 or direction[1] == 0 else bishopSliders
+            table, positive = RAYS[direction]
+            blockers = table[sq] & occupied
+            if blockers & sliders: # only the nearest piece on the ray can attack along it
+                first = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+                if sliders >> first & 1:
+                    return True
         return False
-    
-    def getPawnMoves(self, r, c, moves):
-        
-        # get white pawn moves
-
-        if self.whiteToMove: # white pawn moves
-
-            if self.board[r-1][c] == "--" and r-1>=0: # one square pawn advance
-                moves.append(Move((r,c),(r-1,c),self.board))
-                if r==6 and self.board[r-2][c] == "--": # two square pawn advance
-                    moves.append(Move((r,c),(r-2,c),self.board))
-            if (c-1>=0):  # captures to left
-                if (self.board[r-1][c-1][0] == "b"):
-                    moves.append(Move((r,c),(r-1,c-1),self.board))
-            if  (c+1<=7): # captures to right
-                if (self.board[r-1][c+1][0] == "b"):
-                    moves.append(Move((r,c),(r-1,c+1),self.board))
-        
-        # get black pawn moves
-        
-        if not self.whiteToMove and r+1<=7: # black pawn moves
-
-            if self.board[r+1][c] == "--": # one square pawn advance
-                moves.append(Move((r,c),(r+1,c),self.board))
-                if r==1 and self.board[r+2][c] == "--": # two square pawn advance
-                    moves.append(Move((r,c),(r+2,c),self.board))
-            if (c-1>=0):  # captures to left
-                if (self.board[r+1][c-1][0] == "w"):
-                    moves.append(Move((r,c),(r+1,c-1),self.board))
-            if  (c+1<=7): # captures to right
-                if (self.board[r+1][c+1][0] == "w"):
-                    moves.append(Move((r,c),(r+1,c+1),self.board))
 
+    def attackersOf(self, square, color):
+        '''(row, col) squares of every piece of the given colour ("w" or "b") that attacks square'''
+        attackers = self.attackersBitboard(square[0]*8 + square[1], color, self.occupied)
+        squares = []
+        while attackers:
+            bit = attackers & -attackers
+            attackers ^= bit
+            sq = bit.bit_length() - 1
+            squares.append((sq >> 3, sq & 7))
+        return squares
+
+    def addMoves(self, r, c, targets, moves):
+        '''Append a move from (r, c) to every square set in the targets bitboard'''
+        piece = self.squares[r*8 + c]
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            sq = bit.bit_length() - 1
+            moves.append(Move((r,c), (sq >> 3, sq & 7), None, pieceMoved=piece, pieceCaptured=self.squares[sq]))
     
-    def getRookMoves(self, r, c, moves):
-
-        color = self.board[r][c][0]
-        opColor = "w" if color == "b" else "b"
-
-        directions = [(1,0),(-1,0),(0,1),(0,-1)]
+    def getPawnMoves(self, r, c, moves):
+        sq = r*8 + c
+        color = self.squares[sq][0]
+        opColor = "b" if color == "w" else "w"
+
+        # captures to left and right
+        targets = PAWN_ATTACKS[color][sq] & self.colorBitboards[opColor]
+        push = PAWN_PUSHES[color][sq]
+        if not self.occupied & push: # one square pawn advance
+            targets |= push
+            if not self.occupied & PAWN_DOUBLE_PUSHES[color][sq]: # two square pawn advance
+                targets |= PAWN_DOUBLE_PUSHES[color][sq]
+
+        if r == (1 if color == "w" else 6): # every move promotes, to any of NBRQ
+            while targets:
+                bit = targets & -targets
+                targets ^= bit
+                end = bit.bit_length() - 1
+                for choice in PROMOTION_PIECES:
+                    moves.append(Move((r,c), (end >> 3, end & 7), None, pieceMoved=color+"p",
+                                      pieceCaptured=self.squares[end], promotionChoice=choice))
+        else:
+            self.addMoves(r, c, targets, moves)
 
-        for direction in directions:
-            for i in range(1,8):
-                pos = (r + direction[0]*i, c + direction[1]*i)
-                if (pos[0] > 7) or (pos[1] > 7) or (pos[0]<0) or (pos[1]<0): # out of the board
-                    break
-                if self.board[pos[0]][pos[1]][0] == color: # same type piece
-                    break
-                if self.board[pos[0]][pos[1]][0]  == opColor: # capture an enemy piece
-                    moves.append(Move((r,c), pos, self.board))
-                    break
-                moves.append(Move((r,c), pos, self.board))
+        enpassant = self.enpassantSquare
+        if enpassant != -1 and PAWN_ATTACKS[color][sq] >> enpassant & 1:
+            moves.append(Move((r,c), (enpassant >> 3, enpassant & 7), None, isEnpassantMove=True,
+                              pieceMoved=color+"p", pieceCaptured=opColor+"p"))
 
+    def getRookMoves(self, r, c, moves):
+        sq = r*8 + c
+        own = self.colorBitboards[self.squares[sq][0]]
+        self.addMoves(r, c, slidingAttacks(sq, ROOK_DIRECTIONS, self.occupied) & ~own, moves)
 
     def getKnightMoves(self, r, c, moves):
-
-        # all possible moves
-        positions =[(r+2 , c+1),(r+2 , c-1),(r-1 , c+2),(r+1 , c+2),
-                    (r-2 , c+1),(r-2 , c-1),(r-1 , c-2),(r+1 , c-2)]
-        
-        for pos in positions:
-            if (pos[0]>7) or (pos[0]<0) or (pos[1]>7) or (pos[1]<0) or self.board[r][c][0] == self.board[pos[0]][pos[1]][0]:
-                continue
-            moves.append(Move((r,c), pos, self.board))
+        sq = r*8 + c
+        own = self.colorBitboards[self.squares[sq][0]]
+        self.addMoves(r, c, KNIGHT_ATTACKS[sq] & ~own, moves)
 
     def getBishopMoves(self, r, c, moves):
-
-        color = self.board[r][c][0]
-        opColor = "w" if color == "b" else "b"
-
-        directions = [(1,1),(1,-1),(-1,1),(-1,-1)]
-
-        for direction in directions:
-            for i in range(1,8):
-                pos = (r + direction[0]*i, c + direction[1]*i)
-                if (pos[0] > 7) or (pos[1] > 7) or (pos[0]<0) or (pos[1]<0): # out of the board
-                    break
-                if self.board[pos[0]][pos[1]][0] == color: # same type piece
-                    break
-                if self.board[pos[0]][pos[1]][0]  == opColor: # capture an enemy piece
-                    moves.append(Move((r,c), pos, self.board))
-                    break
-                moves.append(Move((r,c), pos, self.board))
-
+        sq = r*8 + c
+        own = self.colorBitboards[self.squares[sq][0]]
+        self.addMoves(r, c, slidingAttacks(sq, BISHOP_DIRECTIONS, self.occupied) & ~own, moves)
 
     def getQueenMoves(self, r, c, moves):
-        color = self.board[r][c][0]
-        opColor = "w" if color == "b" else "b"
-
-        directions = [(1,1),(1,-1),(-1,1),(-1,-1),(1,0),(-1,0),(0,1),(0,-1)]
-        
-        for direction in directions:
-            for i in range(1,8):
-                pos = (r + direction[0]*i, c + direction[1]*i)
-                if (pos[0] > 7) or (pos[1] > 7) or (pos[0]<0) or (pos[1]<0): # out of the board
-                    break
-                if self.board[pos[0]][pos[1]][0] == color: # same type piece
-                    break
-                if self.board[pos[0]][pos[1]][0]  == opColor: # capture an enemy piece
-                    moves.append(Move((r,c), pos, self.board))
-                    break
-                moves.append(Move((r,c), pos, self.board))
-        
+        sq = r*8 + c
+        own = self.colorBitboards[self.squares[sq][0]]
+        self.addMoves(r, c, slidingAttacks(sq, QUEEN_DIRECTIONS, self.occupied) & ~own, moves)
 
     def getKingMoves(self, r, c, moves):
-        
-        # all possible moves
-        positions = [(r-1 , c),(r-1 , c+1),(r-1 , c-1),(r , c-1),
-                     (r , c+1),(r+1 , c),(r+1 , c-1),(r+1 , c+1)]
-        
-        for pos in positions:
-            if (pos[0]>7) or (pos[0]<0) or (pos[1]>7) or (pos[1]<0) or self.board[r][c][0] == self.board[pos[0]][pos[1]][0]:
-                continue
-            moves.append(Move((r,c), pos, self.board))
+        sq = r*8 + c
+        own = self.colorBitboards[self.squares[sq][0]]
+        self.addMoves(r, c, KING_ATTACKS[sq] & ~own, moves)
 
     def getCastleMoves(self, r, c, moves):
         if self.squareUnderAttack(r,c):
             return # cannot perform castling
-        if (self.whiteToMove and self.currentCastlingRights.wks) or (not self.whiteToMove and self.currentCastlingRights.bks):
+        if self.castlingRights & (CASTLE_WKS if self.whiteToMove else CASTLE_BKS):
             self.getKingSideCastlingMoves(r, c, moves)
-        if (self.whiteToMove and self.currentCastlingRights.wqs) or (not self.whiteToMove and self.currentCastlingRights.bqs):
+        if self.castlingRights & (CASTLE_WQS if self.whiteToMove else CASTLE_BQS):
             self.getQueenSideCastlingMoves(r, c, moves)
 
     def getKingSideCastlingMoves(self, r, c, moves):
-        if self.board[r][c+1] == "--" and self.board[r][c+2] == "--":
+        sq = r*8 + c
+        if not self.occupied & (0b11 << (sq+1)): # both squares between king and rook are empty
             if not self.squareUnderAttack(r,c+1) and not self.squareUnderAttack(r, c+2):
                 moves.append(Move((r,c), (r,c+2), self.board, isCastleMove=  True))
 
 
     def getQueenSideCastlingMoves(self, r, c, moves): 
-        if self.board[r][c-1] == "--" and self.board[r][c-2] == "--" and self.board[r][c-3] == "--":
+        sq = r*8 + c
+        if not self.occupied & (0b111 << (sq-3)): # all three squares between king and rook are empty
             if not self.squareUnderAttack(r,c-1) and not self.squareUnderAttack(r, c-2) :
-                moves.append(Move((r,c), (r,c-3), self.board, isCastleMove=  True))
-        
+                moves.append(Move((r,c), (r,c-2), self.board, isCastleMove=  True))
+
+    # the pseudo-legal move generator of each piece, shared by every GameState
+    moveFunctions = {'p': getPawnMoves, 'R': getRookMoves, 'N': getKnightMoves,
+                     'B': getBishopMoves, 'Q': getQueenMoves, 'K': getKingMoves}
+
 
 class CastleRights():
     def __init__(self, wks, bks, wqs, bqs):
@@ -317,9 +921,20 @@ class CastleRights():
         self.wqs = wqs
         self.bqs = bqs
 
+    def bits(self):
+        '''The four rights packed into an int 0..15'''
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
+
+    @classmethod
+    def fromBits(cls, bits):
+        return cls(bool(bits & CASTLE_WKS), bool(bits & CASTLE_BKS), bool(bits & CASTLE_WQS), bool(bits & CASTLE_BQS))
+
     
 
 class Move():
+    '''A move as handed to the UI and kept in moveLog. The engine itself works on the packed `code`'''
+    __slots__ = ("startRow", "startCol", "endRow", "endCol", "pieceMoved", "pieceCaptured", "isPawnPromotion",
+                 "promotionChoice", "isCastleMove", "isEnpassantMove", "moveID", "code")
 
     ranksToRows = {"1": 7, "2": 6, "3": 5, "4": 4,
                    "5": 3, "6": 2, "7": 1, "8": 0}
@@ -329,15 +944,23 @@ class Move():
                    "e": 4, "f": 5, "g": 6, "h": 7}
     colsToFiles = {v: k for k,v in filesToCols.items()}
 
-    def __init__(self, startSq, endSq, board, isCastleMove = False):
+    def __init__(self, startSq, endSq, board, isCastleMove = False, pieceMoved = None, pieceCaptured = "--",
+                 isEnpassantMove = False, promotionChoice = 'Q'):
+        # the move generators already know the pieces involved and pass them in instead of a board
         self.startRow = startSq[0]
         self.startCol = startSq[1]
         self.endRow = endSq[0]
         self.endCol = endSq[1]
-        self.pieceMoved = board[self.startRow][self.startCol]
-        self.pieceCaptured = board[self.endRow][self.endCol]
+        if board is not None:
+            pieceMoved = board[self.startRow][self.startCol]
+            pieceCaptured = board[self.endRow][self.endCol]
+        self.pieceMoved = pieceMoved
+        self.pieceCaptured = pieceCaptured
         self.isPawnPromotion = False
+        self.promotionChoice = promotionChoice # piece a promoting pawn becomes, one of NBRQ
         self.isCastleMove = isCastleMove
+        # en passant captures the pawn beside the start square, pieceCaptured is that pawn
+        self.isEnpassantMove = isEnpassantMove
 
         if (self.pieceMoved == "wp" and self.endRow == 0) or (self.pieceMoved == "bp" and self.endRow == 7):
             self.isPawnPromotion = True
@@ -345,15 +968,49 @@ class Move():
 
         self.moveID = self.startRow*1000 + self.startCol*100 + self.endRow*10 +self.endCol
 
+        flag = FLAG_NONE
+        if isCastleMove:
+            flag = FLAG_CASTLE
+        elif isEnpassantMove:
+            flag = FLAG_EN_PASSANT
+        elif self.isPawnPromotion:
+            flag = FLAG_PROMOTION + PROMOTION_PIECES.index(promotionChoice)
+            self.moveID += 10000 * (flag - FLAG_PROMOTION + 1) # under-promotions are different moves
+        self.code = self.startRow*8 + self.startCol | (self.endRow*8 + self.endCol) << 6 | flag << 12
+
+    @classmethod
+    def fromCode(cls, code, squares):
+        '''Unpack a 16-bit move, reading the pieces involved from the 64-entry GameState.squares list'''
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12
+        if flag == FLAG_EN_PASSANT:
+            captured = squares[(start & 56) | (end & 7)]
+        else:
+            captured = squares[end]
+        return cls((start >> 3, start & 7), (end >> 3, end & 7), None, isCastleMove = flag == FLAG_CASTLE,
+                   pieceMoved = squares[start], pieceCaptured = captured, isEnpassantMove = flag == FLAG_EN_PASSANT,
+                   promotionChoice = PROMOTION_PIECES[flag - FLAG_PROMOTION] if flag >= FLAG_PROMOTION else 'Q')
+
     def __eq__(self,other):
         if isinstance(other, Move):
             return self.moveID == other.moveID
 
     
     def getChessNotation(self):
-        return self.getRankFile(self.startRow, self.startCol)+ self.getRankFile(self.endRow, self.endCol)
+        notation = self.getRankFile(self.startRow, self.startCol)+ self.getRankFile(self.endRow, self.endCol)
+        if self.isPawnPromotion:
+            notation += self.promotionChoice.lower()
+        return notation
 
 
     def getRankFile(self, r, c):
         return self.colsToFiles[c]+self.rowsToRanks[r]
-    
\ No newline at end of file
+
+
+# hot paths measured while profiling is enabled
+chessProfile.PROFILER.register(GameState, ["getValidMoves", "getCachedMoves", "getLegalMoves", "getLegalMoveCodes",
+                                           "getFilteredMoves", "getAllPosiibleMoves", "inCheck", "squareUnderAttack",
+                                           "isSquareAttacked", "makeMove", "undoMove", "makePackedMove",
+                                           "undoPackedMove", "updateAttackMaps", "rebuildAttackMaps"])
+chessProfile.PROFILER.register(Move, ["__init__", "fromCode"])
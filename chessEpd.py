@@ -0,0 +1,160 @@
+"""
+Streaming batch analysis of EPD (or FEN) files.
+The input is read lazily line by line and handed to a process pool in small chunks, with only a bounded
+number of chunks in flight, so files of any size run in constant memory. For every position it reports
+the legal move count, check, mate and stalemate status and optionally the engine's best move, as JSON lines,
+in input order or in the order they finish.
+
+    python chessEpd.py positions.epd --depth 3 -o results.jsonl
+    python chessEpd.py positions.epd --no-search --unordered --workers 8
+    cat positions.fen | python chessEpd.py -
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import chessEngine
+import chessSearch
+
+
+def parseEpd(line):
+    '''(FEN, operations) of an EPD line. EPD has the four position fields of FEN followed by
+    "opcode operand;" operations, the move counters come from the hmvc and fmvn operations.
+    A full FEN line is accepted as well'''
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError("EPD needs at least 4 fields: " + repr(line))
+    rest = fields[4] if len(fields) > 4 else ""
+    counters = rest.split(None, 2)
+    if len(counters) >= 2 and counters[0].isdigit() and counters[1].isdigit(): # FEN move counters
+        fen = " ".join(fields[:4] + counters[:2])
+        rest = counters[2] if len(counters) > 2 else ""
+    else:
+        fen = None
+    operations = {}
+    for operation in rest.split(";"):
+        parts = operation.strip().split(None, 1)
+        if parts:
+            operations[parts[0]] = parts[1].strip().strip('"') if len(parts) > 1 else ""
+    if fen is None:
+        fen = " ".join(fields[:4] + [operations.get("hmvc", "0"), operations.get("fmvn", "1")])
+    return fen, operations
+
+
+def readPositions(lines):
+    '''Yield (line number, text) for every line that holds a position, skipping blanks and # comments'''
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield number, line
+
+
+def readChunks(positions, chunkSize):
+    '''Group the positions into lists of chunkSize, lazily'''
+    chunk = []
+    for position in positions:
+        chunk.append(position)
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def analysePosition(number, line, depth, search):
+    '''Result record of one EPD line. A line that does not parse gives a record with an error instead'''
+    record = {"line": number}
+    try:
+        fen, operations = parseEpd(line)
+        gs = chessEngine.GameState(fen)
+    except (ValueError, KeyError, IndexError) as error:
+        record["error"] = str(error)
+        return record
+    moves, inCheck = gs.getCachedMoves()
+    record.update({"fen": gs.getFen(), "legalMoves": len(moves), "inCheck": inCheck,
+                   "checkmate": not moves and inCheck, "stalemate": not moves and not inCheck})
+    if operations:
+        record["operations"] = operations
+    if depth > 0 and moves:
+        result = search.search(gs, depth)
+        record.update({"bestMove": result.bestMove.getChessNotation(), "score": result.score,
+                       "pv": [move.getChessNotation() for move in result.pv], "nodes": result.nodes})
+    return record
+
+
+def analyseChunk(chunk, depth, ttSizeBits):
+    '''Worker: the records of a list of (line number, text)'''
+    search = chessSearch.Search(ttSizeBits) if depth > 0 else None
+    return [analysePosition(number, line, depth, search) for number, line in chunk]
+
+
+def analyseStream(lines, depth=0, workers=None, chunkSize=64, ordered=True, ttSizeBits=16, maxInFlight=None):
+    '''Yield a record for every position in lines, an iterable of text lines such as an open file.
+    At most maxInFlight chunks (default four per worker) are read ahead, whichever order is asked for'''
+    workers = workers or os.cpu_count() or 1
+    maxInFlight = maxInFlight or workers * 4
+    chunks = readChunks(readPositions(lines), chunkSize)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque() if ordered else set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < maxInFlight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                future = pool.submit(analyseChunk, chunk, depth, ttSizeBits)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+            if not pending:
+                break
+            if ordered: # the oldest chunk first, later ones keep running meanwhile
+                for record in pending.popleft().result():
+                    yield record
+            else:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for record in future.result():
+                        yield record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse every position of an EPD or FEN file, streaming JSON lines")
+    parser.add_argument("input", help="EPD or FEN file, one position per line, - for standard input")
+    parser.add_argument("--depth", type=int, default=2, help="search depth for the best move")
+    parser.add_argument("--no-search", action="store_true", help="only count moves and report check status")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=64, help="positions per task sent to a worker")
+    parser.add_argument("--unordered", action="store_true", help="write results as they finish, not in input order")
+    parser.add_argument("-o", "--output", help="write the records here instead of standard output")
+    args = parser.parse_args(argv)
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    output = open(args.output, "w") if args.output else sys.stdout
+    count = errors = 0
+    start = time.perf_counter()
+    try:
+        for record in analyseStream(source, 0 if args.no_search else args.depth, args.workers, args.chunk_size,
+                                    not args.unordered):
+            output.write(json.dumps(record) + "\n")
+            count += 1
+            errors += "error" in record
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    summary = {"positions": count, "errors": errors, "time": round(elapsed, 4),
+               "positionsPerSecond": round(count / elapsed, 1) if elapsed > 0 else 0}
+    print(json.dumps({"summary": summary}), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Static evaluation: material plus middlegame and endgame piece-square tables, blended by game phase.
+GameState keeps the running totals up to date in placePiece/removePiece, so evaluate() is O(1).
+"""
+
+PIECE_VALUES = {"p": 100, "N": 320, "B": 330, "R": 500, "Q": 900, "K": 0}
+# game phase counts down from 24 (all minor and major pieces on the board) towards 0 (pawn endings)
+PHASE_WEIGHTS = {"p": 0, "N": 1, "B": 1, "R": 2, "Q": 4, "K": 0}
+MAX_PHASE = 24
+
+# Piece-square tables from white's point of view, laid out like the board: the first row is rank 8.
+# Square sq of the table is therefore square sq of GameState, black reads the mirrored square sq ^ 56.
+PAWN_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+     5,  5, 10, 25, 25, 10,  5,  5,
+     0,  0,  0, 20, 20,  0,  0,  0,
+     5, -5,-10,  0,  0,-10, -5,  5,
+     5, 10, 10,-20,-20, 10, 10,  5,
+     0,  0,  0,  0,  0,  0,  0,  0]
+
+PAWN_ENDGAME_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+    80, 80, 80, 80, 80, 80, 80, 80,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    30, 30, 30, 30, 30, 30, 30, 30,
+    20, 20, 20, 20, 20, 20, 20, 20,
+    10, 10, 10, 10, 10, 10, 10, 10,
+    10, 10, 10, 10, 10, 10, 10, 10,
+     0,  0,  0,  0,  0,  0,  0,  0]
+
+KNIGHT_TABLE = [
+   -50,-40,-30,-30,-30,-30,-40,-50,
+   -40,-20,  0,  0,  0,  0,-20,-40,
+   -30,  0, 10, 15, 15, 10,  0,-30,
+   -30,  5, 15, 20, 20, 15,  5,-30,
+   -30,  0, 15, 20, 20, 15,  0,-30,
+   -30,  5, 10, 15, 15, 10,  5,-30,
+   -40,-20,  0,  5,  5,  0,-20,-40,
+   -50,-40,-30,-30,-30,-30,-40,-50]
+
+BISHOP_TABLE = [
+   -20,-10,-10,-10,-10,-10,-10,-20,
+   -10,  0,  0,  0,  0,  0,  0,-10,
+   -10,  0,  5, 10, 10,  5,  0,-10,
+   -10,  5,  5, 10, 10,  5,  5,-10,
+   -10,  0, 10, 10, 10, 10,  0,-10,
+   -10, 10, 10, 10, 10, 10, 10,-10,
+   -10,  5,  0,  0,  0,  0,  5,-10,
+   -20,-10,-10,-10,-10,-10,-10,-20]
+
+ROOK_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+     5, 10, 10, 10, 10, 10, 10,  5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+     0,  0,  0,  5,  5,  0,  0,  0]
+
+QUEEN_TABLE = [
+   -20,-10,-10, -5, -5,-10,-10,-20,
+   -10,  0,  0,  0,  0,  0,  0,-10,
+   -10,  0,  5,  5,  5,  5,  0,-10,
+    -5,  0,  5,  5,  5,  5,  0, -5,
+     0,  0,  5,  5,  5,  5,  0, -5,
+   -10,  5,  5,  5,  5,  5,  0,-10,
+   -10,  0,  5,  0,  0,  0,  0,-10,
+   -20,-10,-10, -5, -5,-10,-10,-20]
+
+KING_TABLE = [
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -20,-30,-30,-40,-40,-30,-30,-20,
+   -10,-20,-20,-20,-20,-20,-20,-10,
+    20, 20,  0,  0,  0,  0, 20, 20,
+    20, 30, 10,  0,  0, 10, 30, 20]
+
+KING_ENDGAME_TABLE = [
+   -50,-40,-30,-20,-20,-30,-40,-50,
+   -30,-20,-10,  0,  0,-10,-20,-30,
+   -30,-10, 20, 30, 30, 20,-10,-30,
+   -30,-10, 30, 40, 40, 30,-10,-30,
+   -30,-10, 30, 40, 40, 30,-10,-30,
+   -30,-10, 20, 30, 30, 20,-10,-30,
+   -30,-30,  0,  0,  0,  0,-30,-30,
+   -50,-30,-30,-30,-30,-30,-30,-50]
+
+MIDDLEGAME_TABLES = {"p": PAWN_TABLE, "N": KNIGHT_TABLE, "B": BISHOP_TABLE,
+                     "R": ROOK_TABLE, "Q": QUEEN_TABLE, "K": KING_TABLE}
+ENDGAME_TABLES = {"p": PAWN_ENDGAME_TABLE, "N": KNIGHT_TABLE, "B": BISHOP_TABLE,
+                  "R": ROOK_TABLE, "Q": QUEEN_TABLE, "K": KING_ENDGAME_TABLE}
+
+
+def buildSquareScores(tables):
+    '''Per piece string, the signed score (white positive) of that piece on every square'''
+    scores = {}
+    for kind, table in tables.items():
+        scores["w" + kind] = list(table)
+        scores["b" + kind] = [-table[sq ^ 56] for sq in range(64)]
+    return scores
+
+
+# signed per-piece terms, looked up by GameState.placePiece/removePiece
+MATERIAL = {color + kind: (value if color == "w" else -value) for color in "wb" for kind, value in PIECE_VALUES.items()}
+PHASE = {color + kind: weight for color in "wb" for kind, weight in PHASE_WEIGHTS.items()}
+MIDDLEGAME_SCORES = buildSquareScores(MIDDLEGAME_TABLES)
+ENDGAME_SCORES = buildSquareScores(ENDGAME_TABLES)
+
+
+def computeEvaluationTerms(gs):
+    '''(material, middlegame, endgame, phase) of gs recomputed from scratch, to cross-check the incremental totals'''
+    material = middlegame = endgame = phase = 0
+    for sq in range(64):
+        piece = gs.squares[sq]
+        if piece != "--":
+            material += MATERIAL[piece]
+            middlegame += MIDDLEGAME_SCORES[piece][sq]
+            endgame += ENDGAME_SCORES[piece][sq]
+            phase += PHASE[piece]
+    return material, middlegame, endgame, phase
+
+
+def evaluate(gs):
+    '''Score in centipawns from the point of view of the side to move'''
+    phase = min(gs.phase, MAX_PHASE) # promotions can push the count past the starting total
+    score = gs.material + int((gs.middlegameScore * phase + gs.endgameScore * (MAX_PHASE - phase)) / MAX_PHASE)
+    return score if gs.whiteToMove else -score
@@ -2,33 +2,73 @@
 It handles user input and current GameState
 """
 import pygame as p
+import chessArchive
 import chessEngine
+import chessWorker
 import math
-
-p.init()
+import os
+import sys
+from chessProfile import PROFILER
 
 WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT//DIMENSION
 MAX_FPS = 15 # for animations
 IMAGES = {}
+ATLAS_PATH = "images/atlas%d.png" # the piece images scaled to a square size, side by side in one file
+# redraw only the squares that changed and sleep until the next event when idle,
+# instead of redrawing the whole window MAX_FPS times a second
+DIRTY_RECT_RENDERING = True
+ENGINE_COLOR = None # "w" or "b" to let the engine play that side, None for two players
+ENGINE_TIME = 2.0 # seconds the engine thinks per move
+ENGINE_PONDER = True # keep thinking on the opponent's time
+ENGINE_POLL_MS = 50 # how often the window checks for engine progress while it thinks
+PROFILE_REFRESH_MS = 500 # how often the profiling overlay is redrawn while it is shown
+PROFILE_PATH = "profile.json" # where 'd' dumps the profiling stats
+ARCHIVE_PATH = None # e.g. "games.cga" to append every game to a chessArchive when it is reset or the window closes
+FONTS = {}
 
 def loadImages():
     """
     Initialize a global dictionary of images
-    This will be created exacly once
+    This will be created exacly once. The scaled images are cached as one atlas file,
+    so later launches load a single image instead of scaling every piece
     """
     pieces = ["wp", "wR", "wN", "wB", "wQ", "wK", "bR", "bN", "bB", "bQ", "bK", "bp"]
-    for piece in pieces:
-        IMAGES[piece] = p.transform.scale(p.image.load('images/'+piece+'.png'), (SQ_SIZE, SQ_SIZE))
+    sources = ['images/'+piece+'.png' for piece in pieces]
+    atlasPath = ATLAS_PATH % SQ_SIZE
+    if os.path.exists(atlasPath) and all(os.path.getmtime(atlasPath) >= os.path.getmtime(source) for source in sources):
+        atlas = p.image.load(atlasPath)
+    else:
+        atlas = p.Surface((SQ_SIZE*len(pieces), SQ_SIZE), p.SRCALPHA)
+        for i, source in enumerate(sources):
+            atlas.blit(p.transform.scale(p.image.load(source), (SQ_SIZE, SQ_SIZE)), (i*SQ_SIZE, 0))
+        try:
+            p.image.save(atlas, atlasPath)
+        except (OSError, p.error):
+            pass # e.g. a read-only install, which then scales the images on every launch
+    atlas = atlas.convert_alpha()
+    for i, piece in enumerate(pieces):
+        IMAGES[piece] = atlas.subsurface((i*SQ_SIZE, 0, SQ_SIZE, SQ_SIZE))
 
 
-def main():
+def startDisplay():
     """
-    The main driver for our code. Will handle user inputs and update graphics
+    Initialize pygame, open the window and load the images. Importing this module does none of it,
+    so the engine process, which imports it again, and headless tools never start pygame
     """
+    p.init()
     screen = p.display.set_mode((WIDTH,HEIGHT))
     p.display.set_caption("Chess - 1.0")
+    loadImages()
+    return screen
+
+
+def main():
+    """
+    The main driver for our code. Will handle user inputs and update graphics
+    """
+    screen = startDisplay()
     clock = p.time.Clock()
     screen.fill(p.Color("white"))
     gs = chessEngine.GameState()
@@ -36,18 +76,33 @@ def main():
     moveMade = False # flag variable
     animate = False # flag variable to indicate when we should animate
 
-    loadImages() # only once before the while loop
     running = True
     sqSelected =() # no square is selected initially, keep track of the last click of the user, tuple:(row, col)
     playerClicks = [] #keep track of player clicks
     gameOver = False
+    renderer = None
+    if DIRTY_RECT_RENDERING:
+        renderer = BoardRenderer(screen)
+        p.event.set_blocked(p.MOUSEMOTION) # nothing on the board follows the mouse, so do not wake up for it
+    worker = None
+    if ENGINE_COLOR is not None:
+        worker = chessWorker.EngineWorker()
+        worker.start()
+    engineReply = None # the reply the engine expects to its own move, to ponder on
+    overlayRect = None # where the profiling overlay was drawn last frame
+    archive = chessArchive.ArchiveWriter(ARCHIVE_PATH) if ARCHIVE_PATH is not None else None
+    loaded = False # the game on the board came from the archive, so it is not archived again
 
     while running:
+        humanTurn = worker is None or gs.whiteToMove != (ENGINE_COLOR == "w")
         for e in p.event.get():
             if e.type == p.QUIT:
                 running = False
+            elif e.type in (p.VIDEOEXPOSE, p.WINDOWEXPOSED):
+                if renderer is not None:
+                    renderer.invalidate() # the window contents were lost, repaint everything
             elif e.type == p.MOUSEBUTTONDOWN:
-                if not gameOver:
+                if not gameOver and humanTurn:
                     location = p.mouse.get_pos() # (x,y) location of the mouse
                     col = location[0]//SQ_SIZE
                     row = location[1]//SQ_SIZE
@@ -75,37 +130,116 @@ def main():
             elif e.type == p.KEYDOWN:
                 if e.key == p.K_z: #undo when 'z' is pressed
                     gs.undoMove()
+                    if worker is not None:
+                        worker.cancel()
+                        engineReply = None
+                        if gs.whiteToMove == (ENGINE_COLOR == "w"): # take back the engine's move too
+                            gs.undoMove()
                     moveMade = True
                     animate = False
-                if e.key == p.K_r: # reset the board
-                    gs = chessEngine.GameState()
+                if e.key == p.K_p: # profile the engine and the rendering, with an overlay of the stats
+                    PROFILER.toggle()
+                if e.key == p.K_d: # dump the profiling stats
+                    PROFILER.dumpJson(PROFILE_PATH)
+                    print("profile written to " + PROFILE_PATH)
+                if e.key == p.K_r or (e.key == p.K_l and archive is not None and archive.games):
+                    if worker is not None:
+                        worker.cancel()
+                        engineReply = None
+                    if archive is not None and gs.moveLog and not loaded:
+                        archive.writeGameState(gs)
+                        archive.flush()
+                    loaded = e.key == p.K_l
+                    if loaded: # show the last archived game, its moves can be taken back with 'z'
+                        with chessArchive.GameArchive(ARCHIVE_PATH) as games:
+                            gs = games.gameState(len(games) - 1, moveLog=True)
+                    else: # reset the board
+                        gs = chessEngine.GameState()
                     validMoves = gs.getValidMoves()
                     sqSelected =() 
                     playerClicks = []
                     moveMade = False
                     animate = False
-        
+
+        if worker is not None:
+            for update in worker.poll():
+                if not update.pondering:
+                    p.display.set_caption("Chess - 1.0  depth %d  score %d  %s" % (update.depth, update.score,
+                        " ".join(move.getChessNotation() for move in update.moves(gs))))
+                if update.final and not update.pondering and update.bestMove is not None:
+                    move = chessEngine.Move.fromCode(update.bestMove, gs.squares)
+                    for validMove in validMoves:
+                        if move == validMove:
+                            gs.makeMove(validMove)
+                            moveMade = True
+                            animate = True
+                            engineReply = update.pv[1] if len(update.pv) > 1 else None
+
         if moveMade :
              if animate:
-                animateMove(gs.moveLog[-1], screen, gs.board, clock)
+                if renderer is not None:
+                    renderer.animateMove(gs.moveLog[-1], gs, clock)
+                else:
+                    animateMove(gs.moveLog[-1], screen, gs.board, clock)
              validMoves = gs.getValidMoves()
              moveMade = False
              animate = False
+             if worker is not None and worker.isBusy():
+                 worker.cancel() # a human move ends pondering, an undo ends the search of the old position
 
-        if len(gs.getValidMoves())==0 and gs.inCheck():
-            gameOver = True
+        # these only look up the moves cached for the current position
+        gameOver = gs.isCheckmate() or gs.isStalemate()
+        text = None
+        if gs.isCheckmate():
             if gs.whiteToMove:
-                drawText(screen, 'Black wins by checkmate')
+                text = 'Black wins by checkmate'
             else:
-                drawText(screen, 'White wins by checkmate')
+                text = 'White wins by checkmate'
 
-        elif len(gs.getValidMoves())==0 and not gs.inCheck():
-            gameOver = True
-            drawText(screen, 'Stalemate')
-        drawState(screen, gs, validMoves, sqSelected)
-        
-        clock.tick(MAX_FPS)
-        p.display.flip()
+        elif gs.isStalemate():
+            text = 'Stalemate'
+
+        if worker is not None and not gameOver and running:
+            if gs.whiteToMove == (ENGINE_COLOR == "w"):
+                if not worker.isSearching():
+                    worker.search(gs, ENGINE_TIME) # starts warm if it pondered on this position
+            elif ENGINE_PONDER and engineReply is not None and not worker.isBusy():
+                worker.ponder(gs, engineReply)
+                engineReply = None
+
+        if renderer is not None:
+            if overlayRect is not None:
+                renderer.invalidateRect(overlayRect) # repaint the squares the last overlay covered
+            renderer.draw(gs, validMoves, sqSelected, text)
+            overlayRect = None
+            if PROFILER.enabled:
+                overlayRect = drawProfileOverlay(screen)
+                p.display.update(overlayRect)
+            if running:
+                # sleep until something happens, the loop above handles it. While the engine thinks
+                # or the overlay is shown, wake up regularly to collect progress and refresh the stats
+                timeout = 0
+                if worker is not None and worker.isBusy():
+                    timeout = ENGINE_POLL_MS
+                elif PROFILER.enabled:
+                    timeout = PROFILE_REFRESH_MS
+                e = p.event.wait(timeout)
+                if e.type != p.NOEVENT:
+                    p.event.post(e)
+        else:
+            drawState(screen, gs, validMoves, sqSelected)
+            if text is not None:
+                drawText(screen, text)
+            if PROFILER.enabled:
+                drawProfileOverlay(screen)
+            clock.tick(MAX_FPS)
+            p.display.flip()
+    if worker is not None:
+        worker.close()
+    if archive is not None:
+        if gs.moveLog and not loaded:
+            archive.writeGameState(gs)
+        archive.close()
 
 
 def highlightSquares(screen, gs, validMoves, sqSelected):
@@ -132,26 +266,12 @@ def highlightSquares(screen, gs, validMoves, sqSelected):
 
               
 def highlightCheckSquare(screen, gs):
-    s = p.Surface((SQ_SIZE,SQ_SIZE))
-    s.set_alpha(175)
-    s.fill(p.Color("red"))
-
-    if gs.whiteToMove:
-        gs.whiteToMove = not gs.whiteToMove
-        validMoves = gs.getValidMoves()
-        for move in validMoves:
-            if move.endRow == gs.whiteKingPosition[0] and move.endCol == gs.whiteKingPosition[1]:
-                screen.blit(s, (move.endCol*SQ_SIZE, move.endRow*SQ_SIZE))
-        gs.whiteToMove = not gs.whiteToMove
-
-    if not gs.whiteToMove:
-        gs.whiteToMove = not gs.whiteToMove
-        validMoves = gs.getValidMoves()
-        for move in validMoves:
-            if move.endRow == gs.blackKingPosition[0] and move.endCol == gs.blackKingPosition[1]:
-                screen.blit(s, (move.endCol*SQ_SIZE, move.endRow*SQ_SIZE))
-
-        gs.whiteToMove = not gs.whiteToMove
+    checkSquare = gs.checkSquare()
+    if checkSquare is not None:
+        s = p.Surface((SQ_SIZE,SQ_SIZE))
+        s.set_alpha(175)
+        s.fill(p.Color("red"))
+        screen.blit(s, (checkSquare[1]*SQ_SIZE, checkSquare[0]*SQ_SIZE))
 
 
 
@@ -191,7 +311,10 @@ def animateMove(move, screen, board, clock):
 
         # draw the captured piece back
         if move.pieceCaptured != "--":
-            screen.blit(IMAGES[move.pieceCaptured], endSquare)
+            if move.isEnpassantMove: # the captured pawn stands beside the start square
+                screen.blit(IMAGES[move.pieceCaptured], p.Rect(move.endCol*SQ_SIZE, move.startRow*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+            else:
+                screen.blit(IMAGES[move.pieceCaptured], endSquare)
 
         # draw the moving piece
         screen.blit(IMAGES[move.pieceMoved], p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
@@ -212,6 +335,166 @@ def drawText(screen, text):
     textObject = font.render(text , True, p.Color('Black'))
     textLocation = p.Rect(0, 0, WIDTH, HEIGHT).move(WIDTH/2 - textObject.get_width()/2, HEIGHT/2 - textObject.get_height()/2)
     screen.blit(textObject, textLocation)
+    return textLocation
+
+
+def drawProfileOverlay(screen):
+    """Draw the most time consuming instrumented functions in the top left corner and return the rect covered"""
+    if "overlay" not in FONTS:
+        FONTS["overlay"] = p.font.SysFont("Courier", 11)
+    font = FONTS["overlay"]
+    lines = ["%-34s %7s %10s %8s" % ("function", "calls", "time", "allocs")] + PROFILER.formatLines(12)
+    rendered = [font.render(line, True, p.Color("white")) for line in lines]
+    lineHeight = font.get_linesize()
+    rect = p.Rect(0, 0, min(WIDTH, max(text.get_width() for text in rendered) + 8), lineHeight * len(rendered) + 8)
+    background = p.Surface(rect.size)
+    background.set_alpha(190)
+    background.fill(p.Color("black"))
+    screen.blit(background, rect)
+    for i, text in enumerate(rendered):
+        screen.blit(text, (4, 4 + i * lineHeight))
+    return rect
+
+
+def renderBoardSurface():
+    """Draw the empty board once, the renderer copies squares out of it"""
+    surface = p.Surface((WIDTH, HEIGHT))
+    drawBoard(surface)
+    return surface
+
+
+def highlightSurface(color, alpha):
+    s = p.Surface((SQ_SIZE,SQ_SIZE))
+    s.set_alpha(alpha)
+    s.fill(p.Color(color))
+    return s
+
+
+# what a square shows on top of the board colour
+HIGHLIGHT_NONE = 0
+HIGHLIGHT_SELECTED = 1
+HIGHLIGHT_MOVE = 2
+HIGHLIGHT_CAPTURE = 3
+
+
+class BoardRenderer():
+    """
+    Draws the game state by repainting only the squares whose contents changed since the last frame.
+    Every square is described by (piece, in check, highlight), the previous frame's descriptions are kept
+    and only the squares whose description differs are redrawn and pushed with display.update
+    """
+    def __init__(self, screen):
+        self.screen = screen
+        self.boardSurface = renderBoardSurface()
+        self.checkSurface = highlightSurface("red", 175)
+        self.selectedSurface = highlightSurface("blue", 100)
+        self.moveSurface = highlightSurface("yellow", 100)
+        self.captureSurfaces = [self.moveSurface, highlightSurface("white", 100), highlightSurface("brown3", 100)]
+        self.squareRects = [p.Rect(sq % 8 * SQ_SIZE, sq // 8 * SQ_SIZE, SQ_SIZE, SQ_SIZE) for sq in range(64)]
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget what is on the screen, the next draw repaints every square"""
+        self.lastFrame = [None] * 64
+        self.lastText = None
+
+    def invalidateRect(self, rect):
+        """The next draw repaints the squares under rect, e.g. after something was drawn over them"""
+        for sq in rect.collidelistall(self.squareRects):
+            self.lastFrame[sq] = None
+
+    def squareStates(self, gs, validMoves, sqSelected):
+        frame = [(piece, False, HIGHLIGHT_NONE) for piece in gs.squares]
+        checkSquare = gs.checkSquare()
+        if checkSquare is not None:
+            sq = checkSquare[0]*8 + checkSquare[1]
+            frame[sq] = (frame[sq][0], True, HIGHLIGHT_NONE)
+        if sqSelected != ():
+            r,c = sqSelected
+            if gs.board[r][c][0] == ("w" if gs.whiteToMove else "b"):
+                sq = r*8 + c
+                frame[sq] = (frame[sq][0], frame[sq][1], HIGHLIGHT_SELECTED)
+                for move in validMoves:
+                    if move.startRow == r and move.startCol == c:
+                        sq = move.endRow*8 + move.endCol
+                        highlight = HIGHLIGHT_CAPTURE if frame[sq][0] != "--" else HIGHLIGHT_MOVE
+                        frame[sq] = (frame[sq][0], frame[sq][1], highlight)
+        return frame
+
+    def drawSquare(self, sq, state):
+        piece, inCheck, highlight = state
+        rect = self.squareRects[sq]
+        self.screen.blit(self.boardSurface, rect, rect)
+        if inCheck:
+            self.screen.blit(self.checkSurface, rect)
+        if highlight == HIGHLIGHT_SELECTED:
+            self.screen.blit(self.selectedSurface, rect)
+        elif highlight == HIGHLIGHT_MOVE:
+            self.screen.blit(self.moveSurface, rect)
+        elif highlight == HIGHLIGHT_CAPTURE:
+            for s in self.captureSurfaces:
+                self.screen.blit(s, rect)
+        if piece != "--":
+            self.screen.blit(IMAGES[piece], rect)
+
+    def draw(self, gs, validMoves, sqSelected, text=None):
+        """Repaint the changed squares and the text over the board, returns the list of updated rects"""
+        frame = self.squareStates(gs, validMoves, sqSelected)
+        if text != self.lastText:
+            self.lastFrame = [None] * 64 # the old text may cover any square
+        dirty = []
+        for sq in range(64):
+            if frame[sq] != self.lastFrame[sq]:
+                self.drawSquare(sq, frame[sq])
+                dirty.append(self.squareRects[sq])
+        if text is not None and dirty:
+            dirty.append(drawText(self.screen, text))
+        self.lastFrame = frame
+        self.lastText = text
+        if dirty:
+            p.display.update(dirty)
+        return dirty
+
+    def animateMove(self, move, gs, clock):
+        """
+        Slide the moved piece from its start square to its end square. The position without the moving piece
+        is drawn once into a background surface, after that every frame only restores the rect the piece
+        left and blits the piece at its new place
+        """
+        frame = [(piece, False, HIGHLIGHT_NONE) for piece in gs.squares]
+        endSq = move.endRow*8 + move.endCol
+        if move.isEnpassantMove: # the captured pawn stands beside the start square
+            frame[endSq] = ("--", False, HIGHLIGHT_NONE)
+            frame[move.startRow*8 + move.endCol] = (move.pieceCaptured, False, HIGHLIGHT_NONE)
+        else:
+            frame[endSq] = (move.pieceCaptured, False, HIGHLIGHT_NONE)
+        for sq in range(64):
+            self.drawSquare(sq, frame[sq])
+        background = self.screen.copy()
+        p.display.flip()
+
+        dR = move.endRow - move.startRow
+        dC = move.endCol - move.startCol
+        framesPerSquare = (int(2/math.sqrt(abs(dR) + abs(dC)+1))+1) * 4 # frames to move one square
+        frameCount = (abs(dR) + abs(dC)) * framesPerSquare
+        lastRect = self.squareRects[move.startRow*8 + move.startCol]
+        for frameNumber in range(frameCount+1):
+            r, c = (move.startRow + dR*frameNumber/frameCount), (move.startCol + dC*frameNumber/frameCount)
+            rect = p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+            self.screen.blit(background, lastRect, lastRect)
+            self.screen.blit(IMAGES[move.pieceMoved], rect)
+            p.display.update([lastRect, rect])
+            lastRect = rect
+            clock.tick(60)
+        self.lastFrame = frame
+        self.lastFrame[endSq] = None # the piece was drawn there by the last animation frame
+        self.lastText = None
+
+
+# render phases measured while profiling is enabled
+PROFILER.register(sys.modules[__name__], ["drawState", "drawBoard", "drawPieces", "highlightSquares",
+                                          "highlightCheckSquare", "animateMove", "drawText"], "chessMain")
+PROFILER.register(BoardRenderer, ["draw", "squareStates", "drawSquare", "animateMove"])
 
 
 if __name__ == "__main__":
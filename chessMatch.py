@@ -0,0 +1,202 @@
+"""
+Headless self-play: plays batches of games between the search engine and/or a random mover
+across worker processes, adjudicates them and streams one JSON record per finished game.
+Only chessEngine and chessSearch are used, pygame is never imported.
+
+    python chessMatch.py --games 1000 --white random --black random
+    python chessMatch.py --games 100 --white engine --black engine --depth 3 --random-plies 4 -o games.jsonl
+    python chessMatch.py --games 100 --white engine --black engine --book book.bin --tablebases tablebases
+    python chessMatch.py --games 10000 --quiet --archive games.cga
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import chessArchive
+import chessBook
+import chessEngine
+import chessSearch
+import chessTablebase
+
+PLAYERS = ("random", "engine")
+# how a game ended, and the result it gives. checkmate is decided by the side to move
+TERMINATIONS = ("checkmate", "stalemate", "repetition", "fifty-move", "tablebase", "move-limit", "time-limit")
+
+
+class MatchSettings():
+    '''Limits and engine settings shared by every game of a match'''
+    def __init__(self, maxPlies=400, gameTime=None, moveTime=None, depth=3, nodes=None, randomPlies=0, ttSizeBits=16,
+                 bookPath=None, tablebasePath=None):
+        self.maxPlies = maxPlies # the game is drawn after this many plies
+        self.gameTime = gameTime # seconds, the game is drawn once it has taken longer
+        self.moveTime = moveTime # seconds per engine move
+        self.depth = depth # maximum engine search depth
+        self.nodes = nodes # maximum engine nodes per move
+        self.randomPlies = randomPlies # opening plies played at random by both sides, so engine games differ
+        self.ttSizeBits = ttSizeBits
+        self.bookPath = bookPath # opening book the engine plays from while the position is in it
+        self.tablebasePath = tablebasePath # directory of tablebases that end won and drawn endings at once
+
+
+def adjudicate(gs, plies, elapsed, settings, tablebases=None):
+    '''(result, termination) if the game is over, otherwise None'''
+    moves, inCheck = gs.getCachedMoves()
+    if not moves:
+        if inCheck:
+            return ("0-1" if gs.whiteToMove else "1-0"), "checkmate"
+        return "1/2-1/2", "stalemate"
+    if gs.repetitionCount() >= 3:
+        return "1/2-1/2", "repetition"
+    if gs.isFiftyMoveDraw():
+        return "1/2-1/2", "fifty-move"
+    found = tablebases.probe(gs) if tablebases is not None else None
+    if found is not None:
+        if found[0] == chessTablebase.DRAW:
+            return "1/2-1/2", "tablebase"
+        return ("1-0" if (found[0] == chessTablebase.WIN) == gs.whiteToMove else "0-1"), "tablebase"
+    if settings.maxPlies is not None and plies >= settings.maxPlies:
+        return "1/2-1/2", "move-limit"
+    if settings.gameTime is not None and elapsed >= settings.gameTime:
+        return "1/2-1/2", "time-limit"
+    return None
+
+
+def chooseMove(gs, player, search, book, rng, plies, timeLeft, settings):
+    moves = gs.getValidMoves()
+    if player == "random" or plies < settings.randomPlies:
+        return rng.choice(moves)
+    if book is not None:
+        move = book.chooseMove(gs, rng)
+        if move is not None:
+            return move
+    moveTime = settings.moveTime
+    if timeLeft is not None:
+        moveTime = timeLeft if moveTime is None else min(moveTime, timeLeft)
+    result = search.search(gs, settings.depth, moveTime, settings.nodes)
+    if result.bestMove is None or result.bestMove.code not in {move.code for move in moves}:
+        raise RuntimeError("the engine chose an illegal move %s in %s" % (
+            result.bestMove.getChessNotation() if result.bestMove is not None else None, gs.getFen()))
+    return result.bestMove
+
+
+def playGame(index, fen, white, black, settings, seed):
+    '''Worker: play one game and return its result record. "codes" holds the packed moves'''
+    rng = random.Random(seed)
+    gs = chessEngine.GameState(fen)
+    tablebases = chessTablebase.Tablebases(settings.tablebasePath) if settings.tablebasePath else None
+    searches = {"w": None, "b": None}
+    for color, player in (("w", white), ("b", black)):
+        if player == "engine":
+            searches[color] = chessSearch.Search(settings.ttSizeBits, tablebases)
+    book = chessBook.OpeningBook(settings.bookPath) if settings.bookPath and "engine" in (white, black) else None
+    start = time.perf_counter()
+    moves = []
+    codes = []
+    while True:
+        elapsed = time.perf_counter() - start
+        ending = adjudicate(gs, len(moves), elapsed, settings, tablebases)
+        if ending is not None:
+            break
+        color = "w" if gs.whiteToMove else "b"
+        timeLeft = settings.gameTime - elapsed if settings.gameTime is not None else None
+        move = chooseMove(gs, white if color == "w" else black, searches[color], book, rng, len(moves), timeLeft,
+                          settings)
+        gs.makeMove(move)
+        moves.append(move.getChessNotation())
+        codes.append(move.code)
+    if book is not None:
+        book.close()
+    if tablebases is not None:
+        tablebases.close()
+    result, termination = ending
+    return {"game": index, "white": white, "black": black, "fen": fen, "seed": seed, "result": result,
+            "termination": termination, "plies": len(moves), "time": round(time.perf_counter() - start, 4),
+            "moves": " ".join(moves), "codes": codes}
+
+
+def runMatch(games, white, black, settings, fen=None, seed=0, workers=None, alternate=False):
+    '''Play games concurrently on a process pool and yield their records as they finish.
+    At most a few games per worker are queued at a time, so a long match needs no more memory than a short one.
+    With alternate, the players swap colours every other game'''
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        index = 0
+        while index < games or pending:
+            while index < games and len(pending) < workers * 4:
+                players = (black, white) if alternate and index % 2 else (white, black)
+                pending.add(pool.submit(playGame, index, fen, players[0], players[1], settings, seed + index))
+                index += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def summarize(records, elapsed):
+    '''Totals for a list of game records, with games and moves per second of wall time'''
+    results = {"1-0": 0, "0-1": 0, "1/2-1/2": 0}
+    terminations = {termination: 0 for termination in TERMINATIONS}
+    plies = 0
+    for record in records:
+        results[record["result"]] += 1
+        terminations[record["termination"]] += 1
+        plies += record["plies"]
+    return {"games": len(records), "results": results, "terminations": terminations, "moves": plies,
+            "time": round(elapsed, 4), "gamesPerSecond": round(len(records) / elapsed, 2) if elapsed > 0 else 0,
+            "movesPerSecond": round(plies / elapsed, 1) if elapsed > 0 else 0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play batches of headless games and stream the results as JSON lines")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--white", choices=PLAYERS, default="random")
+    parser.add_argument("--black", choices=PLAYERS, default="random")
+    parser.add_argument("--alternate", action="store_true", help="swap the players' colours every other game")
+    parser.add_argument("--fen", help="position every game starts from, default is the start position")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0, help="game i uses seed + i for its random moves")
+    parser.add_argument("--max-plies", type=int, default=400, help="draw a game after this many plies")
+    parser.add_argument("--game-time", type=float, help="draw a game after this many seconds")
+    parser.add_argument("--move-time", type=float, help="seconds per engine move")
+    parser.add_argument("--depth", type=int, default=3, help="engine search depth")
+    parser.add_argument("--nodes", type=int, help="engine nodes per move")
+    parser.add_argument("--random-plies", type=int, default=0, help="play the first plies of every game at random")
+    parser.add_argument("--book", help="opening book for the engine players, see chessBook.py")
+    parser.add_argument("--tablebases", help="directory of KQK/KRK/KPK tables: adjudicates those endings and "
+                                             "lets the engine play them perfectly, see chessTablebase.py")
+    parser.add_argument("-o", "--output", help="write the game records here instead of standard output")
+    parser.add_argument("--archive", help="also append the games to this binary archive, see chessArchive.py")
+    parser.add_argument("--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+
+    settings = MatchSettings(args.max_plies, args.game_time, args.move_time, args.depth, args.nodes, args.random_plies,
+                             bookPath=args.book, tablebasePath=args.tablebases)
+    output = open(args.output, "w") if args.output else sys.stdout
+    archive = chessArchive.ArchiveWriter(args.archive) if args.archive else None
+    records = []
+    start = time.perf_counter()
+    try:
+        for record in runMatch(args.games, args.white, args.black, settings, args.fen, args.seed, args.workers,
+                               args.alternate):
+            codes = record.pop("codes")
+            if archive is not None:
+                archive.writeGame(codes, record["result"], record["fen"])
+            records.append({key: record[key] for key in ("result", "termination", "plies")})
+            if output is not sys.stdout or not args.quiet:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if archive is not None:
+            archive.close()
+    summary = summarize(records, time.perf_counter() - start)
+    print(json.dumps({"summary": summary}), file=sys.stderr if output is sys.stdout and not args.quiet else sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Parallel perft and fixed-depth search over several processes.
+The root move list is split into chunks and every chunk is handed to a worker process.
+Only the 34-byte position encoding and packed move codes go to the workers, and only counts,
+scores and move codes come back. Results are merged in root move order, so they do not
+depend on the number of workers or on which worker finishes first.
+
+    python chessParallel.py perft --depth 5 --workers 8
+    python chessParallel.py search --depth 4 --fen "<FEN>"
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import chessEngine
+import chessPerft
+import chessSearch
+
+
+def rootMoveCodes(gs):
+    buffer = chessEngine.newMoveBuffer()
+    return list(buffer[:gs.getLegalMoveCodes(buffer)])
+
+
+def splitIntoChunks(codes, chunkSize):
+    return [codes[i:i+chunkSize] for i in range(0, len(codes), chunkSize)]
+
+
+def defaultChunkSize(moveCount, workers):
+    '''Several chunks per worker, so that one long subtree does not leave the other workers idle'''
+    return max(1, moveCount // (workers * 4))
+
+
+def perftChunk(position, codes, depth):
+    '''Worker: [(code, leaf nodes below it)] for the given root moves of the encoded position'''
+    gs = chessEngine.GameState.decodePosition(position)
+    buffers = [chessEngine.newMoveBuffer() for ply in range(depth + 1)]
+    results = []
+    for code in codes:
+        gs.makePackedMove(code)
+        results.append((code, chessPerft.perft(gs, depth - 1, buffers)))
+        gs.undoPackedMove()
+    return results
+
+
+def searchChunk(position, codes, depth, ttSizeBits):
+    '''Worker: ([(code, score, pv codes)], nodes, table probes, table hits) for the given root moves'''
+    gs = chessEngine.GameState.decodePosition(position)
+    search = chessSearch.Search(ttSizeBits)
+    search.resetBudget()
+    results = [(pv[0], score, pv) for score, pv in search.searchMoves(gs, codes, depth)]
+    return results, search.nodes, search.tt.probes, search.tt.hits
+
+
+def runChunks(function, position, chunks, extraArgs, workers, executor):
+    '''Call function(position, chunk, *extraArgs) for every chunk on executor, or on a pool of `workers`
+    processes started for this call. The outputs come back in chunk order'''
+    columns = [[position] * len(chunks), chunks] + [[arg] * len(chunks) for arg in extraArgs]
+    if executor is not None:
+        return list(executor.map(function, *columns))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, *columns))
+
+
+def parallelPerft(gs, depth, workers=None, chunkSize=None, executor=None):
+    '''Perft of gs, depth >= 1, split over worker processes.
+    Returns (total nodes, [(move notation, nodes)] in root move order)'''
+    if depth < 1:
+        raise ValueError("the perft depth must be at least 1, not %d" % depth)
+    workers = workers or os.cpu_count() or 1
+    codes = rootMoveCodes(gs)
+    if depth <= 1: # nothing worth sending to another process
+        return len(codes), [(chessEngine.Move.fromCode(code, gs.squares).getChessNotation(), 1) for code in codes]
+    chunks = splitIntoChunks(codes, chunkSize or defaultChunkSize(len(codes), workers))
+    outputs = runChunks(perftChunk, gs.encodePosition(), chunks, (depth,), workers, executor)
+    merged = [result for output in outputs for result in output]
+    divide = [(chessEngine.Move.fromCode(code, gs.squares).getChessNotation(), nodes) for code, nodes in merged]
+    return sum(nodes for notation, nodes in divide), divide
+
+
+def parallelSearch(gs, depth, workers=None, chunkSize=None, executor=None, ttSizeBits=16):
+    '''Fixed-depth search of gs with the root moves split over worker processes. Every worker has its own
+    transposition table. The best score wins, ties go to the earlier root move. Returns a chessSearch.SearchResult'''
+    if depth < 1:
+        raise ValueError("the search depth must be at least 1, not %d" % depth)
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    codes = rootMoveCodes(gs)
+    if not codes:
+        score = -chessSearch.MATE_SCORE if gs.inCheck() else 0
+        return chessSearch.SearchResult(None, [], score, depth, 0, time.perf_counter() - start, 0.0)
+    chunks = splitIntoChunks(codes, chunkSize or defaultChunkSize(len(codes), workers))
+    outputs = runChunks(searchChunk, gs.encodePosition(), chunks, (depth, ttSizeBits), workers, executor)
+
+    bestScore, bestPv = None, None
+    nodes = probes = hits = 0
+    for results, chunkNodes, chunkProbes, chunkHits in outputs:
+        nodes += chunkNodes
+        probes += chunkProbes
+        hits += chunkHits
+        for code, score, pv in results:
+            if bestScore is None or score > bestScore:
+                bestScore, bestPv = score, pv
+    pv = chessSearch.pvToMoves(gs, bestPv)
+    return chessSearch.SearchResult(pv[0], pv, bestScore, depth, nodes, time.perf_counter() - start,
+                                    hits / probes if probes else 0.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft or fixed-depth search split over worker processes")
+    parser.add_argument("mode", choices=["perft", "search"])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fen", help="position to start from, default is the start position")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, help="root moves per task, default gives every worker several")
+    parser.add_argument("--json", action="store_true", help="print the result as one JSON record")
+    args = parser.parse_args(argv)
+    if args.depth < 1:
+        parser.error("--depth must be at least 1")
+
+    gs = chessEngine.GameState(args.fen)
+    start = time.perf_counter()
+    if args.mode == "perft":
+        nodes, divide = parallelPerft(gs, args.depth, args.workers, args.chunk_size)
+        elapsed = time.perf_counter() - start
+        record = {"depth": args.depth, "nodes": nodes, "time": round(elapsed, 4),
+                  "nps": int(nodes / elapsed) if elapsed > 0 else 0, "workers": args.workers}
+    else:
+        result = parallelSearch(gs, args.depth, args.workers, args.chunk_size)
+        record = dict(result.getStats(), workers=args.workers,
+                      bestMove=result.bestMove.getChessNotation() if result.bestMove else None)
+    print(json.dumps(record) if args.json else " ".join("%s=%s" % item for item in record.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
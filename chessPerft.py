@@ -0,0 +1,140 @@
+"""
+Perft: counts the leaf nodes of the legal move tree to a fixed depth.
+Used to check the move generator against known results and to measure its speed.
+Runs headless, only chessEngine is needed.
+
+    python chessPerft.py                      run the standard suite
+    python chessPerft.py --depth 4 --json     the suite to depth 4 at most, as JSON lines
+    python chessPerft.py --position kiwipete --depth 3 --divide
+    python chessPerft.py --fen "8/8/8/8/8/8/8/K1k5 w - - 0 1" --depth 5
+"""
+import argparse
+import json
+import sys
+import time
+import chessEngine
+
+# name, FEN and the known node count per depth
+POSITIONS = [
+    ("startpos", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609, 6: 119060324}),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     {1: 48, 2: 2039, 3: 97862, 4: 4085603, 5: 193690690}),
+    ("endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624, 6: 11030083}),
+    ("promotions", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     {1: 6, 2: 264, 3: 9467, 4: 422333, 5: 15833292}),
+    ("talkchess", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     {1: 44, 2: 1486, 3: 62379, 4: 2103487, 5: 89941194}),
+    ("middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     {1: 46, 2: 2079, 3: 89890, 4: 3894594, 5: 164075551}),
+]
+
+# the suite stops deepening a position once the next depth is known to exceed this many nodes
+DEFAULT_MAX_NODES = 1000000
+
+
+def perft(gs, depth, buffers=None):
+    '''Number of leaf nodes depth plies below the position of gs'''
+    if depth <= 0:
+        return 1
+    if buffers is None:
+        buffers = [chessEngine.newMoveBuffer() for ply in range(depth + 1)]
+    buffer = buffers[depth]
+    count = gs.getLegalMoveCodes(buffer)
+    if depth == 1: # bulk counting, the leaves themselves are never played
+        return count
+    nodes = 0
+    for i in range(count):
+        gs.makePackedMove(buffer[i])
+        nodes += perft(gs, depth - 1, buffers)
+        gs.undoPackedMove()
+    return nodes
+
+
+def divide(gs, depth):
+    '''List of (move notation, leaf nodes below it) for every legal move, for hunting down a wrong count'''
+    buffers = [chessEngine.newMoveBuffer() for ply in range(depth + 1)]
+    results = []
+    for move in gs.getValidMoves():
+        gs.makeMove(move)
+        results.append((move.getChessNotation(), perft(gs, depth - 1, buffers)))
+        gs.undoMove()
+    return results
+
+
+def runPerft(name, fen, depth, expected=None):
+    '''Time one perft run and return it as a result record'''
+    gs = chessEngine.GameState(fen)
+    start = time.perf_counter()
+    nodes = perft(gs, depth)
+    elapsed = time.perf_counter() - start
+    return {"position": name, "fen": fen, "depth": depth, "nodes": nodes, "expected": expected,
+            "passed": expected is None or nodes == expected, "time": round(elapsed, 4),
+            "nps": int(nodes / elapsed) if elapsed > 0 else 0}
+
+
+def runSuite(positions=POSITIONS, maxDepth=None, maxNodes=DEFAULT_MAX_NODES):
+    '''Yield a result record for every position and depth of the suite, deepening while the node budget allows'''
+    for name, fen, counts in positions:
+        for depth in sorted(counts):
+            if maxDepth is not None and depth > maxDepth:
+                break
+            if depth > 1 and counts[depth] > maxNodes:
+                break
+            yield runPerft(name, fen, depth, counts[depth])
+
+
+def formatRecord(record):
+    status = "ok" if record["passed"] else "FAILED, expected %d" % record["expected"]
+    return "%-11s depth %d %12d nodes %8.3fs %9d nps  %s" % (record["position"], record["depth"], record["nodes"],
+                                                            record["time"], record["nps"], status)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count move generation leaf nodes (perft)")
+    parser.add_argument("--depth", type=int, help="depth to search, the suite default depends on --max-nodes")
+    parser.add_argument("--position", choices=[name for name, fen, counts in POSITIONS],
+                        help="run a single position from the suite")
+    parser.add_argument("--fen", help="run a single position given as FEN")
+    parser.add_argument("--divide", action="store_true", help="print the node count below every root move")
+    parser.add_argument("--json", action="store_true", help="print one JSON record per line")
+    parser.add_argument("--max-nodes", type=int, default=DEFAULT_MAX_NODES,
+                        help="suite mode: skip depths known to exceed this many nodes")
+    args = parser.parse_args(argv)
+
+    if args.fen or args.position:
+        if args.fen:
+            name, fen, counts = "fen", args.fen, {}
+        else:
+            name, fen, counts = [position for position in POSITIONS if position[0] == args.position][0]
+        depth = args.depth or 3
+        if args.divide:
+            results = divide(chessEngine.GameState(fen), depth)
+            for notation, nodes in results:
+                print(json.dumps({"move": notation, "nodes": nodes}) if args.json else "%s: %d" % (notation, nodes))
+            total = sum(nodes for notation, nodes in results)
+            print(json.dumps({"moves": len(results), "nodes": total}) if args.json else
+                  "\nMoves: %d\nNodes: %d" % (len(results), total))
+            return 0
+        records = [runPerft(name, fen, depth, counts.get(depth))]
+    else:
+        records = runSuite(maxDepth=args.depth, maxNodes=args.max_nodes)
+
+    failures = 0
+    totalNodes = 0
+    totalTime = 0.0
+    for record in records:
+        print(json.dumps(record) if args.json else formatRecord(record), flush=True)
+        failures += not record["passed"]
+        totalNodes += record["nodes"]
+        totalTime += record["time"]
+    summary = {"nodes": totalNodes, "time": round(totalTime, 4),
+               "nps": int(totalNodes / totalTime) if totalTime > 0 else 0, "failures": failures}
+    print(json.dumps({"summary": summary}) if args.json else
+          "total %d nodes in %.3fs, %d nps, %d failed" % (totalNodes, totalTime, summary["nps"], failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
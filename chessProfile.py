@@ -0,0 +1,151 @@
+"""
+Opt-in instrumentation of the engine hot paths and the render phases.
+Modules register the functions worth measuring, enable() swaps them for timing wrappers and disable()
+puts the originals back, so nothing is measured, or slowed down, while profiling is off.
+For every function it records the number of calls, the cumulative time and the net number of memory
+blocks allocated (sys.getallocatedblocks), all inclusive of nested calls.
+
+    python chessProfile.py --games 20 -o profile.json    profile random games and dump the stats
+In the game window, p toggles profiling with an overlay and d dumps the stats to profile.json.
+"""
+import json
+import random
+import sys
+import time
+
+getallocatedblocks = getattr(sys, "getallocatedblocks", lambda: 0) # not every python has it
+
+
+class Profiler():
+    def __init__(self):
+        self.targets = [] # (owner, attribute name, label)
+        self.originals = {} # label -> (owner, name, original attribute) while enabled
+        self.stats = {} # label -> [calls, seconds, allocated blocks]
+        self.enabled = False
+        self.startTime = None
+
+    def register(self, owner, names, prefix=None):
+        '''Measure the functions `names` of owner, a class or a module, whenever profiling is enabled'''
+        prefix = prefix or getattr(owner, "__name__", str(owner))
+        for name in names:
+            self.targets.append((owner, name, prefix + "." + name))
+        if self.enabled:
+            self.disable()
+            self.enable()
+
+    def wrap(self, function, label):
+        stats = self.stats
+        def timed(*args, **kwargs):
+            blocks = getallocatedblocks()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                entry = stats.get(label)
+                if entry is None:
+                    entry = stats[label] = [0, 0.0, 0]
+                entry[0] += 1
+                entry[1] += time.perf_counter() - start
+                entry[2] += getallocatedblocks() - blocks
+        timed.__name__ = function.__name__
+        timed.__doc__ = function.__doc__
+        return timed
+
+    def enable(self):
+        '''Start measuring the registered functions'''
+        if self.enabled:
+            return
+        for owner, name, label in self.targets:
+            original = owner.__dict__.get(name) if isinstance(owner, type) else getattr(owner, name, None)
+            if original is None:
+                continue
+            if isinstance(original, (classmethod, staticmethod)):
+                replacement = type(original)(self.wrap(original.__func__, label))
+            else:
+                replacement = self.wrap(original, label)
+            self.originals[label] = (owner, name, original)
+            setattr(owner, name, replacement)
+        self.enabled = True
+        if self.startTime is None:
+            self.startTime = time.perf_counter()
+
+    def disable(self):
+        '''Put the original functions back, the stats gathered so far are kept'''
+        for owner, name, original in self.originals.values():
+            setattr(owner, name, original)
+        self.originals = {}
+        self.enabled = False
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        return self.enabled
+
+    def reset(self):
+        self.stats.clear()
+        self.startTime = time.perf_counter() if self.enabled else None
+
+    def getStats(self):
+        '''{label: {calls, time, averageTime, allocations}}, the most time consuming first'''
+        ordered = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        return {label: {"calls": calls, "time": round(seconds, 6),
+                        "averageTime": seconds / calls if calls else 0.0, "allocations": blocks}
+                for label, (calls, seconds, blocks) in ordered}
+
+    def dumpJson(self, path):
+        '''Write the stats to path as JSON and return them'''
+        report = {"enabled": self.enabled,
+                  "wallTime": round(time.perf_counter() - self.startTime, 6) if self.startTime is not None else 0.0,
+                  "stats": self.getStats()}
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def formatLines(self, count=10):
+        '''The top entries as short text lines, for the overlay'''
+        lines = []
+        for label, entry in list(self.getStats().items())[:count]:
+            lines.append("%-34s %7d %8.1fms %8d" % (label[-34:], entry["calls"], entry["time"] * 1000,
+                                                   entry["allocations"]))
+        return lines
+
+
+# the profiler everything registers with
+PROFILER = Profiler()
+
+
+def main(argv=None):
+    import argparse # only here, chessEngine imports this module on every start
+    parser = argparse.ArgumentParser(description="Profile the engine on random games and dump the stats as JSON")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--max-plies", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legacy", action="store_true", help="use the filtering move generator")
+    parser.add_argument("-o", "--output", default="profile.json")
+    args = parser.parse_args(argv)
+
+    # the profiler chessEngine registers with is the one of the imported module, not of this script
+    import chessEngine
+    from chessProfile import PROFILER
+    rng = random.Random(args.seed)
+    PROFILER.enable()
+    for game in range(args.games):
+        gs = chessEngine.GameState()
+        gs.useLegalMoveGenerator = not args.legacy
+        for ply in range(args.max_plies):
+            moves = gs.getValidMoves()
+            if not moves:
+                break
+            gs.makeMove(rng.choice(moves))
+    PROFILER.disable()
+    report = PROFILER.dumpJson(args.output)
+    for line in PROFILER.formatLines(20):
+        print(line)
+    print("wall time %.3fs, written to %s" % (report["wallTime"], args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Alpha-beta search on top of chessEngine.GameState.
+Negamax with iterative deepening, a transposition table and a time or node budget.
+It works on packed move codes, Move objects are only built for the result.
+"""
+import time
+import chessEngine
+import chessTablebase
+from chessEvaluation import evaluate, PIECE_VALUES
+
+MATE_SCORE = 100000
+MAX_PLY = 64
+CHECK_INTERVAL = 1024 # nodes between checks of the time and node budget
+
+# transposition table entry bounds
+EXACT = 0
+LOWER_BOUND = 1 # the score is at least this, the search failed high
+UPPER_BOUND = 2 # the score is at most this, the search failed low
+
+
+def scoreToTable(score, ply):
+    '''Mate scores are stored relative to the node instead of the root, so they stay valid at any ply'''
+    if score > MATE_SCORE - MAX_PLY:
+        return score + ply
+    if score < -MATE_SCORE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def scoreFromTable(score, ply):
+    if score > MATE_SCORE - MAX_PLY:
+        return score - ply
+    if score < -MATE_SCORE + MAX_PLY:
+        return score + ply
+    return score
+
+
+def pvToMoves(gs, codes):
+    '''Convert a principal variation of packed moves from the position of gs to Move objects by replaying it'''
+    moves = []
+    for code in codes:
+        moves.append(chessEngine.Move.fromCode(code, gs.squares))
+        gs.makePackedMove(code)
+    for code in codes:
+        gs.undoPackedMove()
+    return moves
+
+
+def undoTo(gs, plies):
+    '''Take back the packed moves of an interrupted search until gs has plies moves played again'''
+    while len(gs.codeLog) > plies:
+        gs.undoPackedMove()
+
+
+class SearchTimeout(Exception):
+    '''Raised inside the search when the time or node budget runs out or stop() is called'''
+
+
+class TranspositionTable():
+    '''Fixed-size table of search results keyed by zobrist key.
+    A slot is only overwritten by a result searched at least as deep, unless it is left over from an earlier search'''
+    def __init__(self, sizeBits=18):
+        self.size = 1 << sizeBits
+        self.mask = self.size - 1
+        self.entries = [None] * self.size # (key, depth, score, bound, move, generation)
+        self.generation = 0
+        self.probes = 0
+        self.hits = 0
+
+    def newSearch(self):
+        self.generation += 1
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key):
+        self.probes += 1
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key, depth, score, bound, move):
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is None or entry[5] != self.generation or depth >= entry[1]:
+            self.entries[index] = (key, depth, score, bound, move, self.generation)
+
+    def hitRate(self):
+        return self.hits / self.probes if self.probes else 0.0
+
+
+class SearchResult():
+    def __init__(self, bestMove, pv, score, depth, nodes, elapsed, ttHitRate):
+        self.bestMove = bestMove # Move, or None when there is no legal move
+        self.pv = pv # list of Move, the principal variation starting with bestMove
+        self.score = score # centipawns from the side to move's point of view
+        self.depth = depth
+        self.nodes = nodes
+        self.time = elapsed
+        self.nps = int(nodes / elapsed) if elapsed > 0 else 0
+        self.ttHitRate = ttHitRate
+
+    def isMateScore(self):
+        return abs(self.score) > MATE_SCORE - MAX_PLY
+
+    def getStats(self):
+        return {"depth": self.depth, "score": self.score, "nodes": self.nodes, "time": self.time,
+                "nps": self.nps, "ttHitRate": self.ttHitRate,
+                "pv": [move.getChessNotation() for move in self.pv]}
+
+
+class Search():
+    '''Reusable searcher. The transposition table is kept between calls to search().
+    With chessTablebase.Tablebases given, positions they cover are scored exactly instead of searched'''
+    def __init__(self, ttSizeBits=18, tablebases=None):
+        self.tt = TranspositionTable(ttSizeBits)
+        self.tablebases = tablebases
+        # one move buffer and principal variation per ply, allocated once
+        self.buffers = [chessEngine.newMoveBuffer() for ply in range(MAX_PLY + 1)]
+        self.pvLines = [[] for ply in range(MAX_PLY + 1)]
+        self.killers = [[0, 0] for ply in range(MAX_PLY + 1)]
+        self.stopped = False
+
+    def stop(self):
+        '''Ask a running search to return its last completed iteration as soon as possible'''
+        self.stopped = True
+
+    def search(self, gs, maxDepth=MAX_PLY, timeLimit=None, nodeLimit=None, callback=None):
+        '''Search gs to maxDepth with iterative deepening, stopping early after timeLimit seconds or nodeLimit nodes.
+        callback, if given, is called with the SearchResult of every completed iteration'''
+        self.resetBudget(timeLimit, nodeLimit)
+        result = SearchResult(None, [], 0, 0, 0, 0.0, 0.0)
+        plies = len(gs.codeLog)
+        for depth in range(1, min(maxDepth, MAX_PLY) + 1):
+            try:
+                score = self.negamax(gs, depth, -MATE_SCORE - 1, MATE_SCORE + 1, 0)
+            except SearchTimeout:
+                undoTo(gs, plies)
+                if result.bestMove is None:
+                    result = self.fallbackResult(gs)
+                break
+            elapsed = time.perf_counter() - self.startTime
+            pv = pvToMoves(gs, self.pvLines[0])
+            result = SearchResult(pv[0] if pv else None, pv, score, depth, self.nodes, elapsed, self.tt.hitRate())
+            if callback is not None:
+                callback(result)
+            if not pv or abs(score) > MATE_SCORE - MAX_PLY: # no legal moves, or a forced mate was found
+                break
+        # report the nodes of an interrupted iteration too
+        result.nodes = self.nodes
+        result.time = time.perf_counter() - self.startTime
+        result.nps = int(result.nodes / result.time) if result.time > 0 else 0
+        return result
+
+    def fallbackResult(self, gs):
+        '''Result for a search stopped before depth 1 completed: the first legal move in search order, unscored,
+        so that a caller always gets a move while there is one'''
+        buffer = self.buffers[0]
+        count = gs.getLegalMoveCodes(buffer)
+        if count == 0:
+            return SearchResult(None, [], 0, 0, 0, 0.0, 0.0)
+        entry = self.tt.probe(gs.zobristKey)
+        code = self.orderMoves(gs, buffer, count, entry[4] if entry is not None else 0, 0)[0]
+        move = chessEngine.Move.fromCode(code, gs.squares)
+        return SearchResult(move, [move], 0, 0, 0, 0.0, 0.0)
+
+    def resetBudget(self, timeLimit=None, nodeLimit=None):
+        '''Start counting time and nodes for a new search'''
+        self.stopped = False
+        self.nodes = 0
+        self.startTime = time.perf_counter()
+        self.deadline = self.startTime + timeLimit if timeLimit is not None else None
+        self.nodeLimit = nodeLimit
+        self.nextCheck = 0 # node count at which checkBudget runs next
+        self.tt.newSearch()
+        for killers in self.killers:
+            killers[0] = killers[1] = 0
+
+    def searchMoves(self, gs, codes, depth):
+        '''Score the given root moves of gs separately with a full window, to depth plies including the move.
+        Each one is deepened a ply at a time so the table can order the final pass.
+        Returns (score, principal variation codes) per move, in the order given. Call resetBudget first'''
+        if depth < 1:
+            raise ValueError("the search depth must be at least 1, not %d" % depth)
+        results = []
+        plies = len(gs.codeLog)
+        for code in codes:
+            gs.makePackedMove(code)
+            try:
+                for childDepth in range(depth):
+                    score = -self.negamax(gs, childDepth, -MATE_SCORE - 1, MATE_SCORE + 1, 1)
+            except SearchTimeout:
+                undoTo(gs, plies)
+                raise
+            results.append((score, [code] + self.pvLines[1]))
+            gs.undoPackedMove()
+        return results
+
+    def checkBudget(self):
+        '''Raise SearchTimeout once the search was stopped or ran out of time or nodes, otherwise set the next check.
+        The node limit is never overshot, the clock is read every CHECK_INTERVAL nodes'''
+        if self.stopped or (self.nodeLimit is not None and self.nodes >= self.nodeLimit) or \
+                (self.deadline is not None and time.perf_counter() >= self.deadline):
+            raise SearchTimeout()
+        self.nextCheck = self.nodes + CHECK_INTERVAL
+        if self.nodeLimit is not None and self.nextCheck > self.nodeLimit:
+            self.nextCheck = self.nodeLimit
+
+    def negamax(self, gs, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes >= self.nextCheck:
+            self.checkBudget()
+        pvLine = self.pvLines[ply]
+        pvLine.clear()
+        if ply > 0 and gs.repetitionCount() > 1:
+            return 0 # treat a repetition as a draw
+        if ply > 0 and self.tablebases is not None:
+            found = self.tablebases.probe(gs)
+            if found is not None:
+                result, plies = found
+                if result == chessTablebase.DRAW:
+                    return 0
+                score = MATE_SCORE - ply - plies
+                return score if result == chessTablebase.WIN else -score
+        if depth <= 0 or ply >= MAX_PLY:
+            return self.quiescence(gs, alpha, beta, ply)
+
+        key = gs.zobristKey
+        ttMove = 0
+        entry = self.tt.probe(key)
+        if entry is not None:
+            ttMove = entry[4]
+            if ply > 0 and entry[1] >= depth:
+                score = scoreFromTable(entry[2], ply)
+                bound = entry[3]
+                if bound == EXACT or (bound == LOWER_BOUND and score >= beta) or (bound == UPPER_BOUND and score <= alpha):
+                    return score
+
+        buffer = self.buffers[ply]
+        count = gs.getLegalMoveCodes(buffer)
+        if count == 0:
+            return -MATE_SCORE + ply if gs.inCheck() else 0
+
+        originalAlpha = alpha
+        bestScore = -MATE_SCORE - 1
+        bestMove = 0
+        for code in self.orderMoves(gs, buffer, count, ttMove, ply):
+            gs.makePackedMove(code)
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            gs.undoPackedMove()
+            if score > bestScore:
+                bestScore = score
+                bestMove = code
+                if score > alpha:
+                    alpha = score
+                    pvLine[:] = [code] + self.pvLines[ply + 1]
+                    if score >= beta:
+                        if gs.squares[code >> 6 & 63] == "--": # remember quiet moves that cut off
+                            killers = self.killers[ply]
+                            if killers[0] != code:
+                                killers[1] = killers[0]
+                                killers[0] = code
+                        break
+
+        if bestScore >= beta:
+            bound = LOWER_BOUND
+        elif bestScore > originalAlpha:
+            bound = EXACT
+        else:
+            bound = UPPER_BOUND
+        self.tt.store(key, depth, scoreToTable(bestScore, ply), bound, bestMove)
+        return bestScore
+
+    def quiescence(self, gs, alpha, beta, ply):
+        '''Search captures and promotions only, so that the evaluation is never taken in the middle of an exchange'''
+        standPat = evaluate(gs)
+        if standPat >= beta or ply >= MAX_PLY:
+            return standPat
+        if standPat > alpha:
+            alpha = standPat
+        buffer = self.buffers[ply]
+        count = gs.getLegalMoveCodes(buffer)
+        squares = gs.squares
+        captures = [buffer[i] for i in range(count)
+                    if squares[buffer[i] >> 6 & 63] != "--" or buffer[i] >> 12 >= chessEngine.FLAG_PROMOTION]
+        captures.sort(key=lambda code: self.captureOrder(squares, code), reverse=True)
+        for code in captures:
+            self.nodes += 1
+            if self.nodes >= self.nextCheck:
+                self.checkBudget()
+            gs.makePackedMove(code)
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undoPackedMove()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def captureOrder(self, squares, code):
+        '''Most valuable victim first, then least valuable attacker'''
+        victim = squares[code >> 6 & 63]
+        value = PIECE_VALUES[victim[1]] * 10 if victim != "--" else 0
+        if code >> 12 >= chessEngine.FLAG_PROMOTION:
+            value += PIECE_VALUES[chessEngine.PROMOTION_PIECES[(code >> 12) - chessEngine.FLAG_PROMOTION]]
+        return value - PIECE_VALUES[squares[code & 63][1]] // 10
+
+    def orderMoves(self, gs, buffer, count, ttMove, ply):
+        '''Transposition table move first, then captures, then killer moves, then the rest'''
+        squares = gs.squares
+        killers = self.killers[ply]
+        def priority(code):
+            if code == ttMove:
+                return 1 << 20
+            if squares[code >> 6 & 63] != "--" or code >> 12 >= chessEngine.FLAG_PROMOTION:
+                return (1 << 16) + self.captureOrder(squares, code)
+            if code == killers[0]:
+                return 1 << 15
+            if code == killers[1]:
+                return (1 << 15) - 1
+            return 0
+        return sorted(buffer[:count], key=priority, reverse=True)
@@ -0,0 +1,261 @@
+"""
+Asyncio game server: one process hosts many concurrent games for bots and other clients over a TCP line protocol.
+Every session keeps its own GameState. Move generation and engine searches run on a shared process pool,
+so the event loop only parses commands and plays moves that are already known to be legal.
+
+Commands are one line of words, every reply is one line of JSON with "ok" and either the result or "error":
+    new [FEN]                 start a game, replies with its session id, status and legal moves
+    move <id> <move>          play a move in coordinate notation (e2e4, e7e8q), as Move.getChessNotation writes it
+    moves <id>                status and legal moves of the game
+    go <id> [depth]           let the engine play a move
+    undo <id>                 take back the last move
+    close <id>                end the session
+    quit                      close the connection
+
+    python chessServer.py serve --port 8765 --workers 4
+    python chessServer.py load --port 8765 --sessions 200 --moves 40    p50/p99 move latency under load
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import chessEngine
+import chessMatch
+import chessSearch
+
+DEFAULT_PORT = 8765
+MAX_SESSIONS = 1000
+COMMANDS = ("new", "move", "moves", "go", "undo", "close")
+SESSION_SETTINGS = chessMatch.MatchSettings(maxPlies=None) # only the rules end a game, not a ply limit
+WORKER = {} # per worker process: the Search kept between engine calls
+
+
+def initWorker(ttSizeBits):
+    WORKER["search"] = chessSearch.Search(ttSizeBits)
+
+
+def replayGame(fen, codes):
+    gs = chessEngine.GameState(fen)
+    for code in codes:
+        gs.makePackedMove(code)
+    return gs
+
+
+def analyseGame(fen, codes):
+    '''Worker: ({notation: packed move} of the legal moves, status) of the game fen followed by codes'''
+    gs = replayGame(fen, codes)
+    moves, inCheck = gs.getCachedMoves()
+    ending = chessMatch.adjudicate(gs, len(codes), 0, SESSION_SETTINGS)
+    result, termination = ending if ending is not None else ("*", None)
+    status = {"fen": gs.getFen(), "toMove": "w" if gs.whiteToMove else "b", "inCheck": inCheck,
+              "result": result, "termination": termination}
+    return {move.getChessNotation(): move.code for move in moves}, status
+
+
+def searchGame(fen, codes, depth, timeLimit):
+    '''Worker: (best packed move or None, search stats) for the game fen followed by codes'''
+    result = WORKER["search"].search(replayGame(fen, codes), depth, timeLimit)
+    return (result.bestMove.code if result.bestMove is not None else None), result.getStats()
+
+
+class Session():
+    '''One game. legal and status describe the current position once analysed, None while they are stale'''
+    def __init__(self, sessionId, fen=None):
+        self.id = sessionId
+        self.gs = chessEngine.GameState(fen)
+        self.fen = self.gs.getFen()
+        self.codes = []
+        self.legal = None
+        self.status = None
+        self.lock = asyncio.Lock() # one command at a time per game, commands of other games interleave freely
+
+    def play(self, code):
+        self.gs.makeMove(chessEngine.Move.fromCode(code, self.gs.squares))
+        self.codes.append(code)
+        self.legal = self.status = None
+
+
+class GameServer():
+    def __init__(self, executor, depth=3, moveTime=1.0, maxSessions=MAX_SESSIONS):
+        self.executor = executor
+        self.depth = depth # engine search depth of the go command
+        self.moveTime = moveTime # seconds, at most, per engine move
+        self.maxSessions = maxSessions
+        self.sessions = {}
+        self.lastId = 0
+
+    async def analyse(self, session):
+        '''Bring session.legal and session.status up to date, off the event loop'''
+        if session.legal is None:
+            loop = asyncio.get_running_loop()
+            session.legal, session.status = await loop.run_in_executor(self.executor, analyseGame, session.fen,
+                                                                       tuple(session.codes))
+
+    async def reply(self, session, **extra):
+        await self.analyse(session)
+        return dict(ok=True, session=session.id, plies=len(session.codes), moves=sorted(session.legal),
+                    **session.status, **extra)
+
+    def getSession(self, args):
+        if not args:
+            raise ValueError("missing session id")
+        session = self.sessions.get(args[0])
+        if session is None:
+            raise ValueError("no session " + args[0])
+        return session
+
+    async def execute(self, command, args):
+        '''The reply to one command. Bad input raises ValueError, which becomes an error reply'''
+        if command not in COMMANDS:
+            raise ValueError("unknown command " + command)
+        if command == "new":
+            if len(self.sessions) >= self.maxSessions:
+                raise ValueError("too many sessions")
+            try:
+                session = Session(str(self.lastId + 1), " ".join(args) or None)
+            except (KeyError, IndexError):
+                raise ValueError("bad FEN")
+            self.lastId += 1
+            self.sessions[session.id] = session
+            async with session.lock:
+                return await self.reply(session)
+        session = self.getSession(args)
+        async with session.lock:
+            if command == "moves":
+                return await self.reply(session)
+            if command == "move":
+                if len(args) < 2:
+                    raise ValueError("missing move")
+                await self.analyse(session)
+                code = session.legal.get(args[1].lower())
+                if code is None:
+                    raise ValueError("illegal move " + args[1])
+                session.play(code)
+                return await self.reply(session, move=args[1].lower())
+            if command == "go":
+                if len(args) > 1 and not args[1].isdigit():
+                    raise ValueError("bad depth " + args[1])
+                depth = int(args[1]) if len(args) > 1 else self.depth
+                loop = asyncio.get_running_loop()
+                code, stats = await loop.run_in_executor(self.executor, searchGame, session.fen, tuple(session.codes),
+                                                         depth, self.moveTime)
+                if code is None:
+                    raise ValueError("no move to play")
+                move = chessEngine.Move.fromCode(code, session.gs.squares).getChessNotation()
+                session.play(code)
+                return await self.reply(session, move=move, search=stats)
+            if command == "undo":
+                if not session.codes:
+                    raise ValueError("no move to undo")
+                session.gs.undoMove()
+                session.codes.pop()
+                session.legal = session.status = None
+                return await self.reply(session)
+            if command == "close":
+                del self.sessions[session.id]
+                return {"ok": True, "session": session.id, "closed": True}
+
+    async def handleClient(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode(errors="replace").split()
+                if not words:
+                    continue
+                if words[0] == "quit":
+                    break
+                try:
+                    response = await self.execute(words[0], words[1:])
+                except ValueError as error:
+                    response = {"ok": False, "error": str(error)}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handleClient, host, port, limit=1 << 16)
+        async with server:
+            await server.serve_forever()
+
+
+def percentile(values, fraction):
+    '''The value below which fraction of the sorted values fall'''
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+async def loadSession(host, port, moves, rng, latencies):
+    '''Load test client: play a game of random moves on its own connection, timing every move command'''
+    reader, writer = await asyncio.open_connection(host, port)
+    async def send(line):
+        writer.write((line + "\n").encode())
+        await writer.drain()
+        return json.loads(await reader.readline())
+    response = await send("new")
+    session = response["session"]
+    for ply in range(moves):
+        if not response["moves"] or response["result"] != "*":
+            break
+        start = time.perf_counter()
+        response = await send("move %s %s" % (session, rng.choice(response["moves"])))
+        latencies.append(time.perf_counter() - start)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+    await send("close " + session)
+    writer.write(b"quit\n")
+    await writer.drain()
+    writer.close()
+
+
+async def loadTest(host, port, sessions, moves, seed=0):
+    '''Play `sessions` concurrent random games against a running server and report the move latency'''
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[loadSession(host, port, moves, random.Random(seed + i), latencies)
+                           for i in range(sessions)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"sessions": sessions, "moves": len(latencies), "time": round(elapsed, 4),
+            "movesPerSecond": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+            "p50": round(percentile(latencies, 0.5) * 1000, 2), "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host many concurrent games over TCP, or load-test such a server")
+    parser.add_argument("command", choices=["serve", "load"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="serve: processes for moves and search")
+    parser.add_argument("--depth", type=int, default=3, help="serve: engine search depth")
+    parser.add_argument("--move-time", type=float, default=1.0, help="serve: seconds per engine move at most")
+    parser.add_argument("--tt-size-bits", type=int, default=16, help="serve: transposition table size per worker")
+    parser.add_argument("--sessions", type=int, default=100, help="load: concurrent games")
+    parser.add_argument("--moves", type=int, default=40, help="load: plies per game at most")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == "load":
+        print(json.dumps(asyncio.run(loadTest(args.host, args.port, args.sessions, args.moves, args.seed))))
+        return 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=initWorker,
+                             initargs=(args.tt_size_bits,)) as executor:
+        server = GameServer(executor, args.depth, args.move_time)
+        print("serving on %s:%d" % (args.host, args.port))
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Startup time of the headless and GUI paths. Every run is a fresh interpreter, so imports, table building
+and pygame initialisation are counted as a user launching the program would see them.
+    headless    import chessEngine and generate the first moves
+    gui-import  import chessMain, which must not start pygame
+    gui         import chessMain, open the window (SDL's dummy driver unless a video driver is set),
+                load the piece images and draw the first frame
+The GUI paths need pygame and the images directory, they report the error otherwise.
+
+    python chessStartup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PATHS = {
+    "headless": "import chessEngine; chessEngine.GameState().getValidMoves()",
+    "gui-import": "import chessMain",
+    "gui": "import chessMain, chessEngine; screen = chessMain.startDisplay(); gs = chessEngine.GameState(); "
+           "chessMain.BoardRenderer(screen).draw(gs, gs.getValidMoves(), ())",
+}
+# run in the child: the time spent in the path's statements, after the interpreter itself has started
+TIMER = "import time; start = time.perf_counter(); %s; print(time.perf_counter() - start)"
+
+
+def timeStartup(statements):
+    '''(seconds of the whole process, seconds inside it) of running statements in a new interpreter'''
+    environment = dict(os.environ, SDL_VIDEODRIVER=os.environ.get("SDL_VIDEODRIVER", "dummy"),
+                       PYGAME_HIDE_SUPPORT_PROMPT="1")
+    start = time.perf_counter()
+    finished = subprocess.run([sys.executable, "-c", TIMER % statements], capture_output=True, text=True,
+                              env=environment, cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.perf_counter() - start
+    if finished.returncode != 0:
+        raise RuntimeError(finished.stderr.strip().splitlines()[-1] if finished.stderr.strip() else "failed")
+    return elapsed, float(finished.stdout.split()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how long the headless and GUI paths take to start")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per path, the median is reported")
+    parser.add_argument("--path", choices=list(PATHS), action="append", help="only these paths, default all")
+    args = parser.parse_args(argv)
+
+    for name in args.path or PATHS:
+        try:
+            runs = [timeStartup(PATHS[name]) for run in range(args.runs)]
+        except RuntimeError as error:
+            print(json.dumps({"path": name, "error": str(error)}))
+            continue
+        print(json.dumps({"path": name, "runs": args.runs,
+                          "process": round(statistics.median(run[0] for run in runs), 4),
+                          "inside": round(statistics.median(run[1] for run in runs), 4),
+                          "first": round(runs[0][1], 4)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Endgame tablebases for king and queen, rook or pawn against a lone king, built by retrograde analysis.
+Every table is a byte per index ((side to move, white king, black king, piece square), see tableIndex),
+written to disk as is and memory-mapped for probing. A byte is BYTE_ILLEGAL, BYTE_DRAW or 2 + the number of plies
+to mate with best play, odd for a win and even for a loss of the side to move.
+The moves come from chessEngine, so the tables follow exactly the rules the engine plays by.
+
+    python chessTablebase.py generate --directory tablebases
+    python chessTablebase.py probe --fen "8/8/8/4k3/8/8/3QK3/8 w - - 0 1"
+"""
+import argparse
+import mmap
+import os
+import sys
+import time
+from array import array
+import chessEngine
+
+TABLE_SIZE = 2 * 64 * 64 * 64
+BYTE_ILLEGAL = 0
+BYTE_DRAW = 1
+MAX_PLIES = 253 # the longest distance to mate a byte can hold
+
+# results for the side to move
+WIN = 1
+DRAW = 0
+LOSS = -1
+
+# the pieces with a table, in the order they have to be generated: a pawn promotes into the others
+TABLE_PIECES = ("Q", "R", "p")
+
+
+def tableName(piece):
+    return "K%sK" % piece.upper()
+
+
+def tableIndex(whiteToMove, whiteKing, blackKing, sq):
+    return (0 if whiteToMove else 1) << 18 | whiteKing << 12 | blackKing << 6 | sq
+
+
+def decodeValue(value):
+    '''(WIN, DRAW or LOSS for the side to move, plies to mate) of a table byte, None for an illegal index'''
+    if value == BYTE_ILLEGAL:
+        return None
+    if value == BYTE_DRAW:
+        return DRAW, 0
+    plies = value - 2
+    return (WIN if plies & 1 else LOSS), plies
+
+
+def generateTable(piece, tables, log=None):
+    '''The table of king and a white `piece` against king as a bytearray. tables holds the finished
+    tables of the pieces a pawn can promote to'''
+    gs = chessEngine.GameState("4k3/8/8/8/8/8/8/4K3 w - - 0 1")
+    gs.removePiece("wK", 60)
+    gs.removePiece("bK", 4)
+    buffer = chessEngine.newMoveBuffer()
+    whitePiece = "w" + piece
+
+    values = bytearray(TABLE_SIZE)
+    remaining = array("b", bytes(TABLE_SIZE)) # children not yet known to be won by the opponent
+    worst = bytearray(TABLE_SIZE) # longest distance among the children won by the opponent, + 1
+    noLoss = bytearray(TABLE_SIZE) # some move reaches a draw or a loss of the opponent
+    buckets = [[] for plies in range(MAX_PLIES + 2)] # (index, won) to settle at that distance
+    legal = []
+    parents = array("i") # forward edges inside the table, turned around below
+    children = array("i")
+
+    # first pass: the moves of every legal position, settling mates, stalemates and moves that leave the table
+    for whiteKing in range(64):
+        gs.placePiece("wK", whiteKing)
+        gs.whiteKingPosition = (whiteKing >> 3, whiteKing & 7)
+        for blackKing in range(64):
+            if blackKing == whiteKing or chessEngine.KING_ATTACKS[whiteKing] >> blackKing & 1:
+                continue
+            gs.placePiece("bK", blackKing)
+            gs.blackKingPosition = (blackKing >> 3, blackKing & 7)
+            for sq in range(64):
+                if sq == whiteKing or sq == blackKing or (piece == "p" and (sq < 8 or sq >= 56)):
+                    continue
+                gs.placePiece(whitePiece, sq)
+                for whiteToMove in (True, False):
+                    gs.whiteToMove = whiteToMove
+                    waiting = blackKing if whiteToMove else whiteKing
+                    if gs.isSquareAttacked(waiting, "w" if whiteToMove else "b", gs.occupied):
+                        continue # the side that just moved left its king in check
+                    index = tableIndex(whiteToMove, whiteKing, blackKing, sq)
+                    legal.append(index)
+                    count = gs.getLegalMoveCodes(buffer)
+                    if count == 0:
+                        if gs.inCheck():
+                            buckets[0].append((index, False))
+                        else:
+                            values[index] = BYTE_DRAW
+                        continue
+                    inside = 0
+                    for i in range(count):
+                        code = buffer[i]
+                        start = code & 63
+                        end = code >> 6 & 63
+                        flag = code >> 12
+                        if flag >= chessEngine.FLAG_PROMOTION:
+                            promoted = chessEngine.PROMOTION_PIECES[flag - chessEngine.FLAG_PROMOTION]
+                            child = tables[promoted][tableIndex(False, whiteKing, blackKing, end)] \
+                                if promoted in tables else BYTE_DRAW
+                        elif end == sq: # the lone king takes the piece
+                            child = BYTE_DRAW
+                        else:
+                            parents.append(index)
+                            if start == whiteKing:
+                                children.append(tableIndex(not whiteToMove, end, blackKing, sq))
+                            elif start == blackKing:
+                                children.append(tableIndex(not whiteToMove, whiteKing, end, sq))
+                            else:
+                                children.append(tableIndex(not whiteToMove, whiteKing, blackKing, end))
+                            inside += 1
+                            continue
+                        result, plies = decodeValue(child)
+                        if result == LOSS:
+                            buckets[plies + 1].append((index, True))
+                            noLoss[index] = 1
+                        elif result == WIN:
+                            worst[index] = max(worst[index], plies + 1)
+                        else:
+                            noLoss[index] = 1
+                    remaining[index] = inside
+                    if inside == 0 and not noLoss[index]: # every move leaves the table into a lost position
+                        buckets[worst[index]].append((index, False))
+                gs.removePiece(whitePiece, sq)
+            gs.removePiece("bK", blackKing)
+        gs.removePiece("wK", whiteKing)
+    if log:
+        log("%s: %d legal positions, %d moves inside the table" % (tableName(piece), len(legal), len(children)))
+
+    # turn the edges around, predecessors of index are parents[first[index]:first[index+1]]
+    first = array("i", bytes(4 * (TABLE_SIZE + 1)))
+    for child in children:
+        first[child + 1] += 1
+    for index in range(TABLE_SIZE):
+        first[index + 1] += first[index]
+    predecessors = array("i", bytes(4 * len(children)))
+    filled = array("i", first)
+    for parent, child in zip(parents, children):
+        predecessors[filled[child]] = parent
+        filled[child] += 1
+    del parents, children, filled
+
+    # second pass: settle positions in order of distance to mate, so every distance is the shortest one
+    for plies in range(MAX_PLIES + 1):
+        for index, won in buckets[plies]:
+            if values[index] != BYTE_ILLEGAL:
+                continue
+            values[index] = 2 + plies
+            for i in range(first[index], first[index + 1]):
+                parent = predecessors[i]
+                if values[parent] != BYTE_ILLEGAL:
+                    continue
+                if not won: # a move into this lost position wins for the parent
+                    buckets[plies + 1].append((parent, True))
+                else:
+                    remaining[parent] -= 1
+                    if plies + 1 > worst[parent]:
+                        worst[parent] = plies + 1
+                    if remaining[parent] == 0 and not noLoss[parent]:
+                        buckets[worst[parent]].append((parent, False))
+        buckets[plies] = None
+    for index in legal:
+        if values[index] == BYTE_ILLEGAL:
+            values[index] = BYTE_DRAW
+    return values
+
+
+def generateTables(directory, log=None):
+    '''Generate every table into directory'''
+    os.makedirs(directory, exist_ok=True)
+    tables = {}
+    for piece in TABLE_PIECES:
+        start = time.perf_counter()
+        tables[piece] = generateTable(piece, tables, log)
+        with open(os.path.join(directory, tableName(piece) + ".tb"), "wb") as f:
+            f.write(tables[piece])
+        if log:
+            log("%s written in %.1fs" % (tableName(piece), time.perf_counter() - start))
+    return tables
+
+
+class Tablebases():
+    '''Probes the tables found in a directory. Missing tables are simply not probed'''
+    def __init__(self, directory):
+        self.files = []
+        self.tables = {}
+        for piece in TABLE_PIECES:
+            path = os.path.join(directory, tableName(piece) + ".tb")
+            if os.path.exists(path) and os.path.getsize(path) == TABLE_SIZE:
+                f = open(path, "rb")
+                self.files.append(f)
+                self.tables[piece] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        for f in self.files:
+            f.close()
+        self.tables = {}
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def probe(self, gs):
+        '''(WIN, DRAW or LOSS for the side to move, plies to mate) of the position of gs,
+        None when it is not covered: other material, a missing table or castling rights left'''
+        occupied = gs.occupied
+        if bin(occupied).count("1") != 3:
+            return None
+        if gs.castlingRights:
+            return None
+        kings = gs.pieceBitboards["wK"] | gs.pieceBitboards["bK"]
+        sq = (occupied ^ kings).bit_length() - 1
+        piece = gs.squares[sq]
+        if piece[1] not in self.tables:
+            return None
+        whiteKing = gs.whiteKingPosition[0]*8 + gs.whiteKingPosition[1]
+        blackKing = gs.blackKingPosition[0]*8 + gs.blackKingPosition[1]
+        if piece[0] == "w":
+            index = tableIndex(gs.whiteToMove, whiteKing, blackKing, sq)
+        else: # swap the colours and mirror the board, so that white has the piece
+            index = tableIndex(not gs.whiteToMove, blackKing ^ 56, whiteKing ^ 56, sq ^ 56)
+        return decodeValue(self.tables[piece[1]][index])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate or probe the KQK, KRK and KPK tablebases")
+    parser.add_argument("command", choices=["generate", "probe"])
+    parser.add_argument("--directory", default="tablebases")
+    parser.add_argument("--fen", help="probe: the position to look up")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        generateTables(args.directory, log=print)
+        return 0
+    if not args.fen:
+        parser.error("probe needs --fen")
+    with Tablebases(args.directory) as tablebases:
+        found = tablebases.probe(chessEngine.GameState(args.fen))
+    if found is None:
+        print("not in the tablebases")
+        return 1
+    result, plies = found
+    print({WIN: "win", DRAW: "draw", LOSS: "loss"}[result] + (" in %d plies" % plies if result else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Runs the search in a background process, so that the game window keeps handling input while the engine thinks.
+The window sends a position with a time budget and polls for progress without blocking:
+every completed iteration comes back as an EngineUpdate with the best move and principal variation so far.
+A search can be cancelled at any time, and the engine can ponder on the opponent's time.
+
+    worker = EngineWorker()
+    worker.start()
+    worker.search(gs, timeLimit=2.0)
+    ...
+    for update in worker.poll(): # once per frame
+        if update.final and not update.pondering:
+            move = chessEngine.Move.fromCode(update.bestMove, gs.squares)
+"""
+import multiprocessing
+import queue
+import chessEngine
+import chessSearch
+
+
+def gamePosition(gs):
+    '''(encoding of the starting position, packed moves played since). Unlike encodePosition alone
+    this keeps the game history, so the worker sees repetitions'''
+    codes = list(gs.codeLog)
+    for code in codes:
+        gs.undoPackedMove()
+    start = gs.encodePosition()
+    for code in codes:
+        gs.makePackedMove(code)
+    return start, codes
+
+
+class EngineUpdate():
+    '''Progress of a background search: sent after every completed iteration, and once more with final set when it ends'''
+    def __init__(self, searchId, pondering, final, result):
+        self.searchId = searchId
+        self.pondering = pondering # the search is of the position after the expected reply
+        self.final = final
+        self.pv = [move.code for move in result.pv] # packed moves, starting with the best one
+        self.score = result.score
+        self.depth = result.depth
+        self.nodes = result.nodes
+        self.time = result.time
+        self.nps = result.nps
+
+    @property
+    def bestMove(self):
+        '''Packed best move, None when the position has no legal move or no iteration completed'''
+        return self.pv[0] if self.pv else None
+
+    def moves(self, gs):
+        '''The principal variation as Move objects, gs must be at the searched position'''
+        return chessSearch.pvToMoves(gs, self.pv)
+
+    def getStats(self):
+        return {"searchId": self.searchId, "pondering": self.pondering, "final": self.final, "depth": self.depth,
+                "score": self.score, "nodes": self.nodes, "time": self.time, "nps": self.nps}
+
+
+class WorkerSearch(chessSearch.Search):
+    '''Search that also stops once the window cancels the request it is working on'''
+    def __init__(self, cancelledId, ttSizeBits):
+        super().__init__(ttSizeBits)
+        self.cancelledId = cancelledId
+        self.searchId = 0
+
+    def checkBudget(self):
+        if self.cancelledId.value >= self.searchId:
+            self.stopped = True
+        super().checkBudget()
+
+
+def workerLoop(requests, updates, cancelledId, ttSizeBits):
+    '''Body of the worker process: run search requests one after another until None arrives.
+    The Search and its transposition table are kept, so a search after pondering starts warm'''
+    search = WorkerSearch(cancelledId, ttSizeBits)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        searchId, position, codes, timeLimit, maxDepth, pondering = request
+        if cancelledId.value >= searchId: # cancelled before it started
+            continue
+        gs = chessEngine.GameState.decodePosition(position)
+        for code in codes:
+            gs.makePackedMove(code)
+        search.searchId = searchId
+        callback = lambda result: updates.put(EngineUpdate(searchId, pondering, False, result))
+        result = search.search(gs, maxDepth, timeLimit, callback=callback)
+        updates.put(EngineUpdate(searchId, pondering, True, result))
+
+
+class EngineWorker():
+    '''
+    Owns the background search process. Every request gets a new search id, cancel() marks every
+    request made so far as cancelled and poll() drops the updates that still arrive for them
+    '''
+    def __init__(self, ttSizeBits=18):
+        self.ttSizeBits = ttSizeBits
+        # spawn a fresh interpreter instead of forking the one that holds the pygame window
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.lastId = 0
+        self.cancelledUpTo = 0 # local copy of the shared value
+        self.activeId = 0 # the running search that is not pondering, 0 if none
+        self.ponderId = 0
+
+    def start(self):
+        self.requests = self.context.Queue()
+        self.updates = self.context.Queue()
+        self.cancelledId = self.context.Value("q", 0)
+        self.process = self.context.Process(target=workerLoop, daemon=True,
+                                            args=(self.requests, self.updates, self.cancelledId, self.ttSizeBits))
+        self.process.start()
+
+    def submit(self, position, codes, timeLimit, maxDepth, pondering):
+        self.cancel() # one search at a time
+        self.lastId += 1
+        self.requests.put((self.lastId, position, codes, timeLimit, maxDepth, pondering))
+        return self.lastId
+
+    def search(self, gs, timeLimit=None, maxDepth=chessSearch.MAX_PLY):
+        '''Start searching the position of gs, cancelling any earlier search or ponder. Returns the search id'''
+        position, codes = gamePosition(gs)
+        self.activeId = self.submit(position, codes, timeLimit, maxDepth, False)
+        return self.activeId
+
+    def ponder(self, gs, expectedCode):
+        '''Think about the position after the expected reply expectedCode until the next search() or cancel().
+        Its updates come back with pondering set, the table it fills makes the following search faster'''
+        position, codes = gamePosition(gs)
+        self.ponderId = self.submit(position, codes + [expectedCode], None, chessSearch.MAX_PLY, True)
+        return self.ponderId
+
+    def cancel(self):
+        '''Stop the running search and forget every request made so far'''
+        if self.cancelledUpTo < self.lastId:
+            self.cancelledUpTo = self.lastId
+            with self.cancelledId.get_lock():
+                self.cancelledId.value = self.lastId
+        self.activeId = 0
+        self.ponderId = 0
+
+    def isSearching(self):
+        '''True while a search() has not sent its final update'''
+        return self.activeId != 0
+
+    def isBusy(self):
+        return self.activeId != 0 or self.ponderId != 0
+
+    def poll(self):
+        '''The updates received since the last call, without blocking. Updates of cancelled requests are dropped'''
+        received = []
+        while True:
+            try:
+                update = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            if update.searchId <= self.cancelledUpTo:
+                continue
+            if update.final:
+                if update.searchId == self.activeId:
+                    self.activeId = 0
+                elif update.searchId == self.ponderId:
+                    self.ponderId = 0
+            received.append(update)
+        return received
+
+    def close(self):
+        if self.process is not None:
+            self.cancel()
+            self.requests.put(None)
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None